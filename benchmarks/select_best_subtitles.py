@@ -0,0 +1,109 @@
+"""Micro-benchmark for SubliminalHelper.select_best_subtitles over synthetic lists of candidate subtitles.
+
+Compares the current single-pass selector against the previous sort-based one (kept here as `sorted_select`), and checks
+that both pick the same subtitles.
+
+    python benchmarks/select_best_subtitles.py --candidates 500 --languages eng fra spa --repeat 20
+"""
+import os
+import sys
+import random
+import argparse
+import timeit
+from operator import itemgetter
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from babelfish import Language
+from subliminal.score import compute_score
+from subliminal.subtitle import Subtitle
+from subliminal.video import Episode
+from plex_sub_downloader.subliminalHelper import SubliminalHelper
+
+MATCHES = ['series', 'season', 'episode', 'year', 'country', 'release_group', 'source', 'resolution', 'video_codec', 'audio_codec']
+
+class SyntheticSubtitle(Subtitle):
+    """A subtitle with a fixed set of matches, so the benchmark measures selection rather than guessit."""
+    provider_name = 'synthetic'
+
+    def __init__(self, language, subtitle_id, matches):
+        super().__init__(language)
+        self.subtitle_id = subtitle_id
+        self.matches = matches
+
+    @property
+    def id(self):
+        return self.subtitle_id
+
+    def get_matches(self, video):
+        return self.matches
+
+
+def build_candidates(count, languages, seed):
+    rng = random.Random(seed)
+    pool = [Language(l) for l in languages] + [Language('deu'), Language('ita'), Language('por')]
+    return [SyntheticSubtitle(rng.choice(pool), str(i), set(rng.sample(MATCHES, rng.randint(0, len(MATCHES)))))
+            for i in range(count)]
+
+
+def sorted_select(helper, video, subtitles, languages):
+    """The selector that select_best_subtitles replaced: filter, decorate, sort twice, then scan once per language."""
+    def get_format(subtitle):
+        return Path(subtitle.get_path(video)).suffix.replace(".", "")
+
+    def get_priority(subtitle):
+        if helper.format_priority is None:
+            return 0
+        fmt = get_format(subtitle)
+        if fmt not in helper.format_priority:
+            return -1
+        return len(helper.format_priority) - helper.format_priority.index(fmt)
+
+    if helper.format_priority is not None:
+        subtitles = [s for s in subtitles if get_format(s) in helper.format_priority]
+    decorated = [(compute_score(s, video), get_priority(s), s) for s in subtitles]
+    decorated.sort(key=itemgetter(1), reverse=True)
+    decorated.sort(key=itemgetter(0), reverse=True)
+    subtitles = [s for score, priority, s in decorated]
+
+    selected = []
+    for lang in languages:
+        for sub in subtitles:
+            if sub.language == lang:
+                selected.append(sub)
+                break
+    return selected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--candidates', type=int, nargs='+', default=[50, 200, 1000], help='numbers of candidate subtitles to try')
+    parser.add_argument('--languages', nargs='+', default=['eng', 'fra', 'spa'], help='languages to select subtitles for')
+    parser.add_argument('--format-priority', nargs='*', default=['srt', 'ass'], help='format_priority config (pass no values for none)')
+    parser.add_argument('--repeat', type=int, default=20, help='number of times to run each selector')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    helper = SubliminalHelper.__new__(SubliminalHelper)
+    helper.format_priority = args.format_priority or None
+    helper._format_priorities = None
+
+    video = Episode('/media/Show/Season 01/Show.S01E02.1080p.WEB-DL.x264-GROUP.mkv', 'Show', 1, 2)
+    languages = [Language(l) for l in args.languages]
+
+    print(f'{"candidates":>10} {"sorted (ms)":>12} {"single pass (ms)":>17} {"speedup":>8}')
+    for count in args.candidates:
+        candidates = build_candidates(count, args.languages, args.seed)
+        expected = sorted_select(helper, video, candidates, languages)
+        actual = helper.select_best_subtitles(video, candidates, languages)
+        if [s.id for s in expected] != [s.id for s in actual]:
+            sys.exit(f'Selectors disagree for {count} candidates: {expected} != {actual}')
+
+        sorted_time = min(timeit.repeat(lambda: sorted_select(helper, video, candidates, languages), number=1, repeat=args.repeat))
+        single_time = min(timeit.repeat(lambda: helper.select_best_subtitles(video, candidates, languages), number=1, repeat=args.repeat))
+        print(f'{count:>10} {sorted_time * 1000:>12.3f} {single_time * 1000:>17.3f} {sorted_time / single_time:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 import os
-import tempfile
+import queue
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from .subliminalHelper import SubliminalHelper
 from subliminal.video import Video as SubVideo
 from subliminal.subtitle import Subtitle
@@ -11,6 +14,18 @@ from plexapi.video import Video, EpisodeSession
 from plexapi.library import LibrarySection
 from plexapi.media import SubtitleStream
 from .plexHelper import PlexHelper
+from .eventCoalescer import LibraryEventCoalescer
+from .hashCache import HashCache
+from .negativeCache import NegativeResultCache, DEFAULT_BACKOFF
+from .searchResults import SearchResultCache
+from .subtitleStore import SubtitleStore
+from .sidecarSubtitles import SidecarIndex, get_alpha3
+from .scanWatermarks import ScanWatermarkStore
+from .processedItems import ProcessedItemStore
+from .reconciler import LibraryReconciler
+from .jobStore import JobStore, DEFAULT_RETRY_BACKOFF
+from .jobQueue import INTERACTIVE, NEW, BACKFILL
+from .plexSession import build_plex_session, RequestStats
 
 log = logging.getLogger('plex-sub-downloader')
 
@@ -20,6 +35,14 @@ class PlexSubDownloader:
         self.config = None
         self.sub = None
         self.plexHelper = None
+        self.jobQueue = None
+        self.libraryEventCoalescer = None
+        self.scanWatermarks = None
+        self.processedItems = None
+        self.reconciler = None
+        self.jobStore = None
+        self.plexRequestStats = None
+        self.sidecarIndex = None
 
     def configure(self, config):
         """initializes and configures the needed classes for PlexSubDownloader to work.
@@ -33,24 +56,215 @@ class PlexSubDownloader:
         self.format_priority = config.get('format_priority', None)
         if self.format_priority is not None and len(self.format_priority) == 0:
             self.format_priority = None
+        if self.subtitle_destination == 'with_media':
+            self.sidecarIndex = SidecarIndex()
+        self.cache_dir = os.path.expanduser(config.get('cache_dir', os.path.join('~', '.cache', 'plex_sub_downloader')))
 
         self.sub = SubliminalHelper(
             providers= config.get('subtitle_providers', None),
             provider_configs=config.get('subtitle_provider_configs', None),
-            format_priority=self.format_priority
+            format_priority=self.format_priority,
+            provider_idle_timeout=config.get('provider_idle_timeout', 1800),
+            provider_keepalive_interval=config.get('provider_keepalive_interval', 600),
+            provider_concurrency=config.get('subtitle_provider_concurrency', 2),
+            provider_failure_threshold=config.get('provider_failure_threshold', 5),
+            provider_failure_cooldown=config.get('provider_failure_cooldown', 300),
+            search_timeout=config.get('subtitle_search_timeout', 120),
+            hash_cache=HashCache(os.path.join(self.cache_dir, 'hashes.db')),
+            negative_cache=self.build_negative_cache(config),
+            result_cache=self.build_result_cache(config),
+            subtitle_store=self.build_subtitle_store(config),
+            cache_config=config.get('subliminal_cache', None),
+            cache_dir=self.cache_dir
             )
         
+        # every worker thread (plus the reconciler and the next episode lookahead) can be talking to Plex at once
+        self.plexRequestStats = RequestStats()
+        plexSession = build_plex_session(pool_size=config.get('webhook_workers', 2) + 2, 
+                                         max_retries=config.get('plex_max_retries', 3),
+                                         stats=self.plexRequestStats)
         self.plexHelper = PlexHelper(baseurl=config['plex_base_url'], 
                                      token=config['plex_auth_token'], 
                                      host=config.get('webhook_host', '127.0.0.1'), 
-                                     port=config.get('webhook_port', 5000))
+                                     port=config.get('webhook_port', 5000),
+                                     session_cache_ttl=config.get('session_cache_ttl', 5),
+                                     account_cache_ttl=config.get('plex_account_cache_ttl', 3600),
+                                     session=plexSession,
+                                     timeout=(config.get('plex_connect_timeout', 5), config.get('plex_read_timeout', 30)))
         
         if config['subtitle_destination'] == 'with_media' and self.plexHelper.check_library_permissions() == False:
             log.error("One or more of the Plex libraries are not readable/writable by the current user.")
             return False
+
+        self.scanWatermarks = ScanWatermarkStore(os.path.join(self.cache_dir, 'scan_watermarks.db'))
+        self.processedItems = ProcessedItemStore(os.path.join(self.cache_dir, 'processed_items.db'))
+        retryBackoff = config.get('job_retry_backoff', DEFAULT_RETRY_BACKOFF)
+        self.jobStore = JobStore(os.path.join(self.cache_dir, 'jobs.db'), retry_backoff=retryBackoff or [])
+
+        reconcileInterval = config.get('reconcile_interval', 0)
+        if reconcileInterval > 0:
+            self.reconciler = LibraryReconciler(plexHelper=self.plexHelper, 
+                                                processedItems=self.processedItems, 
+                                                dispatch=self.dispatch_reconciled_videos, 
+                                                interval=reconcileInterval,
+                                                retry=self.retry_failed_jobs)
+
+        debounce = config.get('library_new_debounce_seconds', 10)
+        if debounce > 0:
+            self.libraryEventCoalescer = LibraryEventCoalescer(dispatch=self.dispatch_library_new_batch, window=debounce)
         return True
+
+    def build_negative_cache(self, config):
+        backoff = config.get('negative_cache_backoff', DEFAULT_BACKOFF)
+        if backoff is None or len(backoff) == 0:
+            return None
+        return NegativeResultCache(os.path.join(self.cache_dir, 'negative_results.db'), backoff=backoff)
+
+    def build_result_cache(self, config):
+        ttl = config.get('search_result_cache_ttl', 3600)
+        if ttl is None or ttl <= 0:
+            return None
+        return SearchResultCache(os.path.join(self.cache_dir, 'search_results.db'), ttl=ttl)
+
+    def build_subtitle_store(self, config):
+        maxSize = config.get('subtitle_store_max_size', 100)
+        if maxSize is None or maxSize <= 0:
+            return None
+        return SubtitleStore(os.path.join(self.cache_dir, 'subtitles.db'), max_size=int(maxSize * 1024 * 1024))
+
+    def start_reconciler(self):
+        """Starts polling Plex for recently added or updated items that the webhook missed, if `reconcile_interval` is set."""
+        if self.reconciler is not None:
+            self.reconciler.start()
+
+    def shutdown(self):
+        """Cleans up anything that PlexSubDownloader keeps open between requests, like provider sessions."""
+        if self.reconciler is not None:
+            self.reconciler.stop()
+        if self.sub is not None:
+            self.sub.terminate()
+
+    def get_status(self):
+        """Returns a dict of stats about PlexSubDownloader's caches, jobs, subtitle providers and requests to Plex
+        (and the reconciler, if it's running)."""
+        status = {'caches': self.sub.get_cache_stats(), 'jobs': self.jobStore.counts(), 'providers': self.sub.get_provider_stats(),
+                  'plex_requests': self.plexRequestStats.stats()}
+        if self.sidecarIndex is not None:
+            status['caches']['sidecar_index'] = self.sidecarIndex.stats()
+        if self.reconciler is not None:
+            status['reconciler'] = self.reconciler.stats()
+        return status
+
+    def set_job_queue(self, jobQueue):
+        """Sets the JobQueue that background work (like batches of library.new events) gets submitted to.
+        :param JobQueue jobQueue:
+        """
+        self.jobQueue = jobQueue
+
+    def submit_job(self, func, *args, priority=NEW):
+        """Runs the given function on the job queue if there is one, otherwise runs it immediately.
+        :param callable func:
+        :param args: arguments to call func with.
+        :param int priority: (Optional) the job's priority class (see jobQueue). Defaults to NEW.
+        :return: False if the job queue was full and the job was dropped, otherwise True.
+        """
+        if self.jobQueue is None:
+            func(*args)
+            return True
+        return self.jobQueue.put(func, *args, priority=priority)
         
 
+    def submit_video_jobs(self, ratingKeys, priority=NEW, chunk_size=50):
+        """Records jobs for the given videos in the job store, and queues them up to be searched for subtitles,
+        `chunk_size` videos per job, so that a large number of videos isn't searched as one batch under one search deadline.
+        Videos that already have a pending or running job aren't queued up again.
+        :param list ratingKeys: list of int rating keys.
+        :param int priority: (Optional) the job's priority class (see jobQueue). Defaults to NEW.
+        :param int chunk_size: (Optional) maximum number of videos per job.
+        :return: False if the job queue was full, otherwise True.
+        """
+        added = self.jobStore.add(ratingKeys, self.config['languages'])
+        return self.submit_job_chunks(added, priority=priority, chunk_size=chunk_size)
+
+    def submit_job_chunks(self, ratingKeys, priority, chunk_size=50):
+        """Queues up the given videos (which already have pending jobs in the job store) to be searched for subtitles,
+        `chunk_size` videos per job. If the job queue fills up, the jobs that couldn't be queued are marked as failed.
+        :param list ratingKeys: list of int rating keys.
+        :param int priority: the job's priority class (see jobQueue).
+        :param int chunk_size: (Optional) maximum number of videos per job.
+        :return: False if the job queue was full, otherwise True.
+        """
+        queued = True
+        for i in range(0, len(ratingKeys), chunk_size):
+            chunk = ratingKeys[i:i + chunk_size]
+            if not queued or self.submit_job(self.run_video_jobs, chunk, priority=priority) == False:
+                self.jobStore.finish(chunk, self.config['languages'], error='Job queue was full')
+                queued = False
+        return queued
+
+    def run_video_jobs(self, ratingKeys, coveredKeys=()):
+        """Retrieves the videos with the given rating keys from Plex and searches for subtitles for all of them at once,
+        keeping their jobs in the job store up to date. Jobs for videos that couldn't be retrieved are marked as failed.
+        :param list ratingKeys: list of int rating keys.
+        :param list coveredKeys: (Optional) list of int rating keys of jobs that are included in the given videos (like the
+        episodes of a season), which finish along with the videos that include them.
+        """
+        coveredKeys = [key for key in coveredKeys if key not in ratingKeys]
+        self.jobStore.start(ratingKeys + coveredKeys, self.config['languages'])
+        try:
+            videos = self.plexHelper.get_video_items(ratingKeys)
+            if len(videos) < len(ratingKeys):
+                log.info(f"{len(ratingKeys) - len(videos)} of the {len(ratingKeys)} videos could not be retrieved.")
+            if len(videos) > 0:
+                self.handle_downloading_video_subtitles(videos)
+        except Exception as e:
+            self.jobStore.finish(ratingKeys + coveredKeys, self.config['languages'], error=str(e))
+            raise
+
+        retrieved = set(video.ratingKey for video in videos)
+        missing = [key for key in ratingKeys if key not in retrieved]
+        self.jobStore.finish([key for key in ratingKeys if key in retrieved], self.config['languages'])
+        self.jobStore.finish(missing, self.config['languages'], error='Could not be retrieved from Plex')
+        if len(coveredKeys) > 0:
+            self.jobStore.finish(coveredKeys, self.config['languages'], error=None if len(missing) == 0 else 'Could not be retrieved from Plex')
+
+    def recover_jobs(self):
+        """Queues up the jobs that were pending (or running) when PlexSubDownloader last stopped, and any failed jobs
+        that are due to be retried."""
+        ratingKeys = self.jobStore.recover(self.config['languages'])
+        if len(ratingKeys) > 0:
+            log.info(f"Recovering {len(ratingKeys)} unfinished jobs")
+            self.submit_job_chunks(ratingKeys, priority=BACKFILL)
+        self.retry_failed_jobs()
+
+    def retry_failed_jobs(self):
+        """Queues up the failed jobs whose retry backoff (see `job_retry_backoff`) has passed.
+        :return: False if the job queue was full, otherwise True.
+        """
+        ratingKeys = self.jobStore.retry(self.config['languages'])
+        if len(ratingKeys) == 0:
+            return True
+
+        log.info(f"Retrying {len(ratingKeys)} failed jobs")
+        return self.submit_job_chunks(ratingKeys, priority=BACKFILL)
+
+    def submit_webhook_event(self, event):
+        """Queues up the given webhook event to be handled in the background. The videos referenced by library.new events
+        are recorded in the job store first, so they aren't lost if PlexSubDownloader stops before they're handled.
+        Play and resume events are queued up ahead of everything else, since someone is waiting on the next episode.
+        :param PlexWebhookEvent event:
+        :return: False if the job queue was full and the event was dropped, otherwise True.
+        """
+        ratingKeys = []
+        if event.event == "library.new" and event.Metadata.ratingKey is not None:
+            ratingKeys = self.jobStore.add([int(event.Metadata.ratingKey)], self.config['languages'])
+        
+        priority = INTERACTIVE if event.event == "media.play" or event.event == "media.resume" else NEW
+        if self.submit_job(self.handle_webhook_event, event, priority=priority) == False:
+            self.jobStore.finish(ratingKeys, self.config['languages'], error='Job queue was full')
+            return False
+        return True
+
     def handle_webhook_event(self, event):
         """Handles the given webhook event. 
         :param PlexWebhookEvent event:
@@ -69,23 +283,51 @@ class PlexSubDownloader:
 
     def handle_library_new_event(self, event):
         """Handles webhook events of type library.new.
-        Retrieves the relevent item from Plex and searches for subtitles.
+        If `library_new_debounce_seconds` is greater than 0, the event is added to the pending batch of library.new events,
+        otherwise the relevent item is retrieved from Plex and searched for subtitles right away.
         :param PlexWebhookEvent event:
         """
         log.info("Handling library.new event")
         log.info(f'Title: {event.Metadata.title}, type: {event.Metadata.type}, section: {event.Metadata.librarySectionTitle}')
         
-        video = self.plexHelper.get_video_item_from_event(event)
-        if video is None:
-            log.info("Video referenced in event could not be retrieved.")
-            return
-        
-        self.handle_downloading_video_subtitles(video)
+        if self.libraryEventCoalescer is not None:
+            self.libraryEventCoalescer.add(event.Metadata)
+        else:
+            self.handle_library_new_batch([event.Metadata])
+
+    def dispatch_library_new_batch(self, metadataList, coveredKeys=()):
+        """Called by the LibraryEventCoalescer when a batch of library.new events is ready.
+        :param list metadataList: list of PlexMetadata objects.
+        :param list coveredKeys: (Optional) rating keys of the events that were dropped because the batch includes them.
+        """
+        if self.submit_job(self.handle_library_new_batch, metadataList, coveredKeys) == False:
+            ratingKeys = [int(metadata.ratingKey) for metadata in metadataList if metadata.ratingKey is not None]
+            self.jobStore.finish(ratingKeys + [int(key) for key in coveredKeys], self.config['languages'], error='Job queue was full')
+
+    def handle_library_new_batch(self, metadataList, coveredKeys=()):
+        """Retrieves the items referenced by a batch of library.new events from Plex, and searches for subtitles
+        for all of them at once.
+        :param list metadataList: list of PlexMetadata objects.
+        :param list coveredKeys: (Optional) rating keys of the events that were dropped because the batch includes them.
+        Their jobs finish along with the batch.
+        """
+        log.info(f"Handling batch of {len(metadataList)} library.new events")
+        ratingKeys = [int(metadata.ratingKey) for metadata in metadataList if metadata.ratingKey is not None]
+        if len(ratingKeys) > 0:
+            self.run_video_jobs(ratingKeys, [int(key) for key in coveredKeys])
+
+    def dispatch_reconciled_videos(self, videos):
+        """Called by the LibraryReconciler with recently added or updated videos that haven't been checked yet.
+        :param list videos: list of plexapi.video.Video objects.
+        :return: False if the videos couldn't be queued up, otherwise True.
+        """
+        return self.submit_video_jobs([video.ratingKey for video in videos], priority=BACKFILL)
 
     def handle_video_play_event(self, event):
         """Handles webhook events of type media.play and media.resume.
             If `set_next_episode_subtitles` is set to True in config, attempts to set subtitles 
-            for the next episode in the series (assuming that the event is for an Episode).
+            for the next `next_episode_prefetch` episodes in the series (assuming that the event is for an Episode).
+            The next episode is handled right away, and the ones after it are queued up to be handled in the background.
             :param PlexWebhookEvent event:
         """
         if self.config.get('set_next_episode_subtitles', False) == False or event.Metadata.type != "episode":
@@ -99,21 +341,33 @@ class PlexSubDownloader:
             log.debug("No session found for this event. Skipping")
             return
         
-        next_episode = self.plexHelper.get_next_episode(session.key)
-        if next_episode is None:
+        next_episodes = self.plexHelper.get_next_episodes(session.key, count=self.config.get('next_episode_prefetch', 1))
+        if len(next_episodes) == 0:
             log.debug("No next episode for this session. Skipping")
             return
         
+        user = self.plexHelper.get_session_user(session)
         subtitle_stream = self.plexHelper.get_selected_subtitles_for_play_session(session)
         if subtitle_stream is None:
-            log.debug("No subtitles set for this session. Setting next episode to show no subtitles.")
-            self.plexHelper.unset_video_subtitles_for_user(video=next_episode, user=session.user)
+            log.debug("No subtitles set for this session. Setting next episodes to show no subtitles.")
+            for next_episode in next_episodes:
+                self.plexHelper.unset_video_subtitles_for_user(video=next_episode, user=user)
             return
                 
-        self.manually_check_video_subtitles(next_episode.key)
-        next_episode.reload()
-        self.plexHelper.select_video_subtitles_for_user(video=next_episode, user=session.user, subtitle_to_match=subtitle_stream)
+        self.set_episode_subtitles_for_user(next_episodes[:1], user, subtitle_stream)
+        if len(next_episodes) > 1:
+            self.submit_job(self.set_episode_subtitles_for_user, next_episodes[1:], user, subtitle_stream, priority=INTERACTIVE)
 
+    def set_episode_subtitles_for_user(self, episodes, user, subtitle_stream):
+        """Downloads any missing subtitles for the given episodes, then selects the subtitles that best match
+        `subtitle_stream` on each of them for the given user.
+        :param list episodes: list of plexapi.video.Episode objects.
+        :param SessionUser user:
+        :param plexapi.media.SubtitleStream subtitle_stream: the subtitles the user is currently watching with.
+        """
+        self.handle_downloading_video_subtitles(episodes)
+        for episode in self.plexHelper.get_video_items([episode.ratingKey for episode in episodes]):
+            self.plexHelper.select_video_subtitles_for_user(video=episode, user=user, subtitle_to_match=subtitle_stream)
 
     def manually_check_video_subtitles(self, video_key):
         """Manually check video for missing subtitles, and try to download missing subs.
@@ -123,21 +377,33 @@ class PlexSubDownloader:
         if video is None:
             log.info(f"Video with key {video_key} could not be retrieved.")
             return 
-        self.handle_downloading_video_subtitles(video)
+        self.handle_downloading_video_subtitles([video])
 
-    def handle_downloading_video_subtitles(self, video):
-        missingVideos = self.get_videos_missing_subtitles([video])
+    def handle_downloading_video_subtitles(self, videos):
+        """Finds the given videos (and their episodes) that are missing subtitles, and downloads subtitles for all of them at once.
+        :param list videos: list of plexapi.video.Video objects.
+        """
+        videos = self.get_videos_to_check(videos)
+        missingVideos = [v for v in videos if self.is_video_missing_subtitles(v)]
         log.info("Found " + str(len(missingVideos)) + " videos missing subtitles")
         log.info([f'{video.title}, {video.key}' for video in missingVideos])
         if len(missingVideos) > 0:
-            subtitles = self.download_subtitles_for_videos(missingVideos)
-
-            if self.subtitle_destination == "metadata":
-                self.upload_subtitles_to_metadata(missingVideos, subtitles)
-            else:
-                self.sub.save_subtitles(subtitles)
+            self.download_and_save_subtitles(missingVideos)
         else:
             log.info("No subtitles to download, doing nothing!")
+        self.processedItems.record(videos)
+
+    def download_and_save_subtitles(self, missingVideos):
+        """Downloads subtitles for the given videos, which are already known to be missing subtitles, and saves them
+        to `subtitle_destination`.
+        :param list missingVideos: list of plexapi.video.Video objects.
+        """
+        subtitles = self.download_subtitles_for_videos(missingVideos)
+
+        if self.subtitle_destination == "metadata":
+            self.upload_subtitles_to_metadata(missingVideos, subtitles)
+        else:
+            self.sub.save_subtitles(subtitles)
         
     def get_videos_missing_subtitles(self,videos):
         """Search the given list of videos for ones that don't already have subtitles.
@@ -147,20 +413,38 @@ class PlexSubDownloader:
         :return: list of Video objects that don't have any subtitles.
         """
 
-        vidsMissingSubs = []
+        vidsToCheck = self.get_videos_to_check(videos)
+        vidsMissingSubs = [v for v in vidsToCheck if self.is_video_missing_subtitles(v)]
+        return vidsMissingSubs
+
+    def get_videos_to_check(self, videos):
+        """Expands the given list of videos into the movies and episodes that should be checked for subtitles,
+        with their streams loaded. Seasons and shows are replaced by their episodes.
+        :param list videos: list of plexapi.video.Video objects.
+        :return: list of plexapi.video.Movie and plexapi.video.Episode objects.
+        """
+        vidsToCheck = []
         for v in videos:
             if v.type == 'movie' or v.type == 'episode':
-                if self.is_video_missing_subtitles(v):
-                    vidsMissingSubs.append(v)
-                
+                vidsToCheck.append(v)
             elif v.type == 'season' or v.type == 'show':
-                eps = v.episodes()
-                for e in eps:
-                    e.reload()
-                    if self.is_video_missing_subtitles(e):
-                        vidsMissingSubs.append(e)
+                vidsToCheck += v.episodes()
 
-        return vidsMissingSubs
+        return self.load_streams_to_check(vidsToCheck)
+
+    def load_streams_to_check(self, videos):
+        """Loads the streams of the given videos, so their subtitles can be checked. Videos that already have a subtitle file
+        next to them for every requested language don't need their streams checked, and are left as they are.
+        :param list videos: list of plexapi.video.Movie and plexapi.video.Episode objects.
+        :return: the videos, in the same order, with their streams loaded.
+        """
+        requestedLanguages = set(self.config['languages'])
+        needStreams = [v for v in videos if len(requestedLanguages.difference(self.get_sidecar_subtitle_languages(v))) > 0]
+        if len(needStreams) < len(videos):
+            log.debug(f'{len(videos) - len(needStreams)} of {len(videos)} videos already have subtitle files for every language')
+
+        loaded = {v.ratingKey: v for v in self.plexHelper.load_streams(needStreams)}
+        return [loaded.get(v.ratingKey, v) for v in videos]
 
     def is_video_missing_subtitles(self, video):
         """Checks the given video to see if it's missing subtitles for any of the languages defined in config['languages'].
@@ -173,13 +457,16 @@ class PlexSubDownloader:
     
     def get_missing_subtitle_languages(self, video):
         """Compares the existing subtitle languages on the video to the languages requested based on config['languages'],
-        and returns requested languages that aren't already present.
+        and returns requested languages that aren't already present. Subtitle files next to the video's file count as present
+        too, even if Plex hasn't picked them up yet. Languages that couldn't be found the last time they were
+        searched for are left out until their backoff (see `negative_cache_backoff`) has passed.
         :param video: plexapi.video.Video object
         :return: array of language codes
         """
-        requestedLanguages = self.config['languages'].copy()
+        sidecarLanguages = self.get_sidecar_subtitle_languages(video)
+        requestedLanguages = [l for l in self.config['languages'] if l not in sidecarLanguages]
 
-        subtitles = video.subtitleStreams()
+        subtitles = self.plexHelper.get_subtitle_streams(video) if len(requestedLanguages) > 0 else []
         
         for subtitle in subtitles:
             if self.format_priority is not None and subtitle.format not in self.format_priority:
@@ -190,8 +477,24 @@ class PlexSubDownloader:
         log.info(f'Video {video.title} {video.key} is missing {len(requestedLanguages)} subtitle languages:')
         log.info(f'{requestedLanguages}')
 
+        suppressedLanguages = self.sub.get_suppressed_languages(video, requestedLanguages)
+        if len(suppressedLanguages) > 0:
+            log.info(f'Skipping {suppressedLanguages} for video {video.title} {video.key}, no subtitles were found the last time they were searched for')
+            requestedLanguages = [l for l in requestedLanguages if l not in suppressedLanguages]
+
         return requestedLanguages
 
+    def get_sidecar_subtitle_languages(self, video):
+        """Returns the requested languages that already have a subtitle file (in one of the `format_priority` formats, if set)
+        next to the given video's file. Only checked when `subtitle_destination` is `with_media`.
+        :param video: plexapi.video.Video object
+        :return: list of language codes
+        """
+        if self.sidecarIndex is None or len(video.media) == 0 or len(video.media[0].parts) == 0:
+            return []
+        found = self.sidecarIndex.get_languages(video.media[0].parts[0].file, self.format_priority)
+        return [l for l in self.config['languages'] if get_alpha3(l) in found]
+
     def download_subtitles_for_videos(self, videos):
         """Attempts to download subtitles for the given list of videos.
         :param list videos: list of plexapi.video.Video objects.
@@ -206,40 +509,157 @@ class PlexSubDownloader:
 
     def upload_subtitles_to_metadata(self, plexVideos, subtitleDict):
         """Saves the subtitles to Plex.
+        Each Plex video is matched to its subtitles by file path, and the uploads for several videos can run at once
+        (see `metadata_upload_concurrency`). An error while uploading to one video is logged, and doesn't stop the others.
         :param list plexVideos: list of plexapi.video.Video objects.
         :param dict subtitles: dict of dict[subliminal.video.Video, list[subliminal.subtitle.Subtitle]]
         """
 
         log.info("Saving subtitles to Plex metadata")
-        tempdir = tempfile.gettempdir()
+        subtitlesByPath = {subVideo.name: (subVideo, subtitles) for subVideo, subtitles in subtitleDict.items() if len(subtitles) > 0}
+        uploads = []
         for video in plexVideos:
-            mediaPart = video.media[0].parts[0]
             filepath = video.media[0].parts[0].file
-            for subVideo, subtitles in subtitleDict.items():
-                if subVideo.name == filepath:
-                    log.debug(f'found {len(subtitles)} subtitles for video {subVideo.name}')
-                    if len(subtitles) == 0:
-                        continue
-                    savedSubtitlePaths = self.sub.save_subtitle(subVideo, subtitles, destination=tempdir)
-                    for subtitlePath in savedSubtitlePaths:
-                        log.debug(f'Uploading subtitles \'{subtitlePath}\' to video {video.title} {video.key}')
-                        originalDefault = None 
-                        existingSubs = video.subtitleStreams();
-                        for sub in existingSubs:
-                            if sub.default:
-                                originalDefault = sub
-                                break
-
-                        video.uploadSubtitles(subtitlePath)
-                        try:
-                            if originalDefault is not None:
-                                mediaPart.setSelectedSubtitleStream(originalDefault)
-                            else:
-                                mediaPart.resetSelectedSubtitleStream()
-                        except Exception as e:
-                            log.debug('Error when trying to set default subtitle stream. This probably isn\'t a big deal?')
-                            log.debug(e)
+            if filepath in subtitlesByPath:
+                subVideo, subtitles = subtitlesByPath[filepath]
+                uploads.append((video, subVideo, subtitles))
+
+        concurrency = self.config.get('metadata_upload_concurrency', 2)
+        if concurrency <= 1 or len(uploads) <= 1:
+            for upload in uploads:
+                try:
+                    self.upload_video_subtitles(*upload)
+                except Exception as e:
+                    log.error(f'Error while trying to upload subtitles to video {upload[0].title} {upload[0].key}')
+                    log.error(e)
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='psd-upload') as executor:
+                futures = {executor.submit(self.upload_video_subtitles, *upload): upload[0] for upload in uploads}
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        video = futures[future]
+                        log.error(f'Error while trying to upload subtitles to video {video.title} {video.key}')
+                        log.error(e)
+
+    def upload_video_subtitles(self, video, subVideo, subtitles):
+        """Uploads the given subtitles to a single video's metadata, one after the other, and then puts the video's
+        selected subtitle stream back the way it was (uploading subtitles makes Plex select them).
+        A failed upload is logged, and the other languages are still uploaded.
+        :param plexapi.video.Video video:
+        :param subliminal.video.Video subVideo:
+        :param list subtitles: list of subliminal.subtitle.Subtitle objects.
+        """
+        log.debug(f'found {len(subtitles)} subtitles for video {subVideo.name}')
+        mediaPart = video.media[0].parts[0]
+        originalDefault = next((sub for sub in mediaPart.subtitleStreams() if sub.default), None)
+
+        for filename, content in self.sub.get_subtitle_files(subVideo, subtitles):
+            log.debug(f'Uploading subtitles \'{filename}\' to video {video.title} {video.key}')
+            try:
+                self.plexHelper.upload_subtitles(video, filename, content)
+            except Exception as e:
+                log.error(f'Error while trying to upload subtitles \'{filename}\' to video {video.title} {video.key}')
+                log.error(e)
+
+        try:
+            if originalDefault is not None:
+                mediaPart.setSelectedSubtitleStream(originalDefault)
+            else:
+                mediaPart.resetSelectedSubtitleStream()
+        except Exception as e:
+            log.debug('Error when trying to set default subtitle stream. This probably isn\'t a big deal?')
+            log.debug(e)
                             
+    def warm_hash_cache(self, sections=None):
+        """Hashes every video file in the given library sections ahead of time, so that later subtitle searches
+        don't need to read the files.
+        :param list sections: (Optional) list of section titles or ids. Defaults to all sections.
+        """
+        directories = []
+        for section in self.plexHelper.get_library_sections(sections):
+            directories = directories + section.locations
+        self.sub.warm_hash_cache(directories)
+
+    def scan_library(self, sections=None, full=False, batch_size=50):
+        """Checks every movie and episode in the given library sections for missing subtitles, and downloads them.
+        Unless `full` is True, only items added or updated since the last scan of each section are checked.
+        :param list sections: (Optional) list of section titles or ids. Defaults to all sections.
+        :param bool full: (Optional) if True, ignores the watermarks left by previous scans and checks every item.
+        :param int batch_size: (Optional) number of videos missing subtitles to search for at once.
+        """
+        for section in self.plexHelper.get_library_sections(sections):
+            if section.type != 'movie' and section.type != 'show':
+                log.debug(f'Skipping library section {section.title} of type {section.type}')
+                continue
+            self.scan_library_section(section, full=full, batch_size=batch_size)
+
+    def scan_library_section(self, section, full=False, batch_size=50):
+        """Scans a single library section for videos missing subtitles.
+        Pages of items are fetched from Plex on a background thread (at most a couple of pages ahead), while videos missing
+        subtitles are collected and searched for `batch_size` at a time. Items come back oldest `updatedAt` first, and once
+        every item up to a point has been handled the section's watermark is moved up to it, so an interrupted scan picks up
+        where it left off.
+        :param plexapi.library.LibrarySection section:
+        :param bool full: (Optional) if True, ignores the section's watermark and checks every item.
+        :param int batch_size: (Optional) number of videos missing subtitles to search for at once.
+        """
+        watermark = None if full else self.scanWatermarks.get_watermark(section.uuid)
+        if watermark is None:
+            log.info(f'Scanning every item in library section {section.title}')
+        else:
+            log.info(f'Scanning items in library section {section.title} updated since {datetime.fromtimestamp(watermark)}')
+
+        pages = queue.Queue(maxsize=2)
+        def fetch_pages():
+            try:
+                for page in self.plexHelper.iter_section_videos(section, updated_since=watermark):
+                    pages.put(page)
+            except Exception as e:
+                log.error(f'Error while trying to list items in library section {section.title}')
+                log.error(e)
+            finally:
+                pages.put(None)
+        threading.Thread(target=fetch_pages, name=f'psd-scan-{section.key}', daemon=True).start()
+
+        checked = 0
+        downloaded = 0
+        pending = []
+        unrecorded = []
+        lastUpdatedAt = None
+        while True:
+            page = pages.get()
+            if page is None:
+                break
+
+            page = self.load_streams_to_check(page)
+            checked += len(page)
+            pending += [video for video in page if self.is_video_missing_subtitles(video)]
+            for video in page:
+                if video.updatedAt is not None:
+                    lastUpdatedAt = max(lastUpdatedAt or 0, int(video.updatedAt.timestamp()))
+
+            unrecorded += page
+
+            if len(pending) >= batch_size:
+                self.download_and_save_subtitles(pending)
+                downloaded += len(pending)
+                pending = []
+            if len(pending) == 0 and lastUpdatedAt is not None:
+                self.processedItems.record(unrecorded)
+                self.scanWatermarks.set_watermark(section.uuid, lastUpdatedAt)
+                unrecorded = []
+
+        if len(pending) > 0:
+            self.download_and_save_subtitles(pending)
+            downloaded += len(pending)
+        self.processedItems.record(unrecorded)
+        if lastUpdatedAt is not None:
+            self.scanWatermarks.set_watermark(section.uuid, lastUpdatedAt)
+
+        log.info(f'Finished scanning library section {section.title}: checked {checked} items, searched for subtitles for {downloaded} of them')
+
     def check_webhook_registration(self):
         return self.plexHelper.check_webhook_registration()
     
@@ -63,10 +63,18 @@ class PlexMetadata(object):
         self.librarySectionType = data.get('librarySectionType', None)
         self.ratingKey = data.get('ratingKey', None)
         self.key = data.get('key', None)
+        self.parentRatingKey = data.get('parentRatingKey', None)
+        self.parentKey = data.get('parentKey', None)
+        self.grandparentRatingKey = data.get('grandparentRatingKey', None)
+        self.grandparentKey = data.get('grandparentKey', None)
         self.guid = data.get('guid', None)
         self.studio = data.get('studio', None)
         self.type = data.get('type', None)
         self.title = data.get('title', None)
+        self.parentTitle = data.get('parentTitle', None)
+        self.grandparentTitle = data.get('grandparentTitle', None)
+        self.index = data.get('index', None)
+        self.parentIndex = data.get('parentIndex', None)
         self.librarySectionTitle = data.get('librarySectionTitle', None)
         self.librarySectionID = data.get('librarySectionID', None)
         self.librarySectionKey = data.get('librarySectionKey', None)
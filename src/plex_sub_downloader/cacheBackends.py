@@ -0,0 +1,212 @@
+import os
+import time
+import pickle
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+from dogpile.cache import register_backend
+from dogpile.cache.api import CacheBackend, NO_VALUE
+from dogpile.cache.proxy import ProxyBackend
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+register_backend('plex_sub_downloader.sqlite', 'plex_sub_downloader.cacheBackends', 'SQLiteBackend')
+register_backend('plex_sub_downloader.file', 'plex_sub_downloader.cacheBackends', 'FileBackend')
+
+def configure_region(region, cache_config, cache_dir):
+    """Configures subliminal's dogpile cache region based on the `subliminal_cache` config.
+    :param dogpile.cache.region.CacheRegion region: the region to configure.
+    :param dict cache_config: the `subliminal_cache` config object (may be None).
+    :param str cache_dir: the directory to keep the cache in, unless cache_config has its own `path`.
+    :return: CacheStatsProxy that counts hits and misses for the region.
+    """
+    cache_config = cache_config or {}
+    backend = cache_config.get('backend', 'sqlite')
+    expiration_time = cache_config.get('expiration_time', None)
+    stats = CacheStatsProxy()
+
+    if backend == 'memory':
+        arguments = {'cache_dict': LRUDict(cache_config.get('max_size', 10000))}
+        backend_name = 'dogpile.cache.memory'
+    elif backend == 'file':
+        arguments = {'directory': cache_config.get('path', os.path.join(cache_dir, 'subliminal_cache'))}
+        backend_name = 'plex_sub_downloader.file'
+    elif backend == 'dbm':
+        arguments = {'filename': cache_config.get('path', os.path.join(cache_dir, 'subliminal_cache.dbm'))}
+        backend_name = 'dogpile.cache.dbm'
+    else:
+        arguments = {'filename': cache_config.get('path', os.path.join(cache_dir, 'subliminal_cache.db')), 'max_age': expiration_time}
+        backend_name = 'plex_sub_downloader.sqlite'
+
+    log.debug(f'Configuring subliminal cache with backend {backend_name} and arguments {arguments}')
+    region.configure(backend_name, expiration_time=expiration_time, arguments=arguments, wrap=[stats])
+    return stats
+
+
+class CacheStatsProxy(ProxyBackend):
+    """Counts cache hits and misses for a dogpile cache region."""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.proxied.get(key)
+        self._count([value])
+        return value
+
+    def get_multi(self, keys):
+        values = self.proxied.get_multi(keys)
+        self._count(values)
+        return values
+
+    def get_serialized(self, key):
+        value = self.proxied.get_serialized(key)
+        self._count([value])
+        return value
+
+    def get_serialized_multi(self, keys):
+        values = self.proxied.get_serialized_multi(keys)
+        self._count(values)
+        return values
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+    def _count(self, values):
+        misses = len([value for value in values if value is NO_VALUE])
+        with self._lock:
+            self.misses += misses
+            self.hits += len(values) - misses
+
+
+class LRUDict:
+    """A thread-safe dict-like object that holds at most `max_size` items, evicting the least recently used one first.
+    Used as the `cache_dict` for dogpile's memory backend.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteBackend(CacheBackend):
+    """A dogpile cache backend that keeps values in a SQLite database running in WAL mode, so that several threads
+    (and processes) can use the cache at once. Takes the arguments `filename`, and optionally `max_age`, the number of seconds
+    after which values are deleted from the database when the backend starts up.
+    """
+
+    def __init__(self, arguments):
+        self.store = _SQLiteCacheStore(arguments['filename'])
+        max_age = arguments.get('max_age', None)
+        if max_age is not None:
+            self.store.execute('DELETE FROM cache WHERE updated < ?', (time.time() - max_age,))
+
+    def get(self, key):
+        rows = self.store.execute('SELECT value FROM cache WHERE key = ?', (key,))
+        if len(rows) == 0:
+            return NO_VALUE
+        return pickle.loads(rows[0][0])
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.store.execute('INSERT OR REPLACE INTO cache (key, value, updated) VALUES (?, ?, ?)',
+                           (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time()))
+
+    def set_multi(self, mapping):
+        now = time.time()
+        self.store.executemany('INSERT OR REPLACE INTO cache (key, value, updated) VALUES (?, ?, ?)',
+                               [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now) for key, value in mapping.items()])
+
+    def delete(self, key):
+        self.store.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def delete_multi(self, keys):
+        self.store.executemany('DELETE FROM cache WHERE key = ?', [(key,) for key in keys])
+
+
+class _SQLiteCacheStore(SQLiteStore):
+    schema = (
+        """CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            updated REAL NOT NULL
+        )""",
+    )
+
+
+class FileBackend(CacheBackend):
+    """A dogpile cache backend that keeps each value in its own file in a local directory. Writes go to a temporary file
+    that's moved into place, so readers never see a partially written value. Takes a single argument, `directory`.
+    """
+
+    def __init__(self, arguments):
+        self.directory = arguments['directory']
+        os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key):
+        try:
+            with open(self._get_path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return NO_VALUE
+        except Exception as e:
+            log.debug(f'Could not read cache file for key {key}: {e}')
+            return NO_VALUE
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        fd, temppath = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temppath, self._get_path(key))
+
+    def set_multi(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def delete(self, key):
+        try:
+            os.remove(self._get_path(key))
+        except FileNotFoundError:
+            pass
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger('plex-sub-downloader')
+
+class LibraryEventCoalescer:
+    """Collects library.new events over a short debounce window, so that a whole season (or show)
+    landing in Plex results in a single batched search instead of one search per episode.
+    Events for episodes and seasons that are already covered by a pending season or show are dropped, and their rating keys
+    are passed along with the batch, so whatever is tracking them can be told that the batch covered them.
+    """
+
+    def __init__(self, dispatch, window=10, max_wait=None):
+        """
+        :param callable dispatch: called with a list of PlexMetadata objects whenever a batch is flushed, and the list of
+        rating keys of the events that were dropped because an item in the batch covers them.
+        :param float window: seconds to wait after the latest event before flushing the batch.
+        :param float max_wait: (Optional) maximum seconds a batch can stay open while new events keep arriving.
+        Defaults to 6 times the window.
+        """
+        self.dispatch = dispatch
+        self.window = window
+        self.max_wait = max_wait if max_wait is not None else window * 6
+        self._pending = {}
+        self._covered = []
+        self._opened_at = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, metadata):
+        """Adds the metadata of a library.new event to the pending batch.
+        :param PlexMetadata metadata:
+        """
+        with self._lock:
+            if metadata.ratingKey in self._pending or self._is_covered(metadata):
+                log.debug(f'{metadata.type} {metadata.ratingKey} is already covered by a pending library.new event')
+                if metadata.ratingKey not in self._pending:
+                    self._covered.append(metadata.ratingKey)
+                return
+
+            if metadata.type == 'show' or metadata.type == 'season':
+                self._remove_covered_by(metadata)
+            self._pending[metadata.ratingKey] = metadata
+            log.debug(f'Added {metadata.type} {metadata.ratingKey} to pending library.new batch ({len(self._pending)} pending)')
+
+            now = time.monotonic()
+            if self._timer is None:
+                self._opened_at = now
+            elif now - self._opened_at < self.max_wait:
+                self._timer.cancel()
+            else:
+                return
+
+            self._timer = threading.Timer(self.window, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Dispatches all pending events as a single batch."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._opened_at = None
+            batch = list(self._pending.values())
+            covered = self._covered
+            self._pending = {}
+            self._covered = []
+
+        if len(batch) > 0:
+            log.info(f'Dispatching batch of {len(batch)} library.new events')
+            self.dispatch(batch, covered)
+
+    def _is_covered(self, metadata):
+        """Returns True if a pending season or show already includes the given item."""
+        parents = [metadata.parentRatingKey, metadata.grandparentRatingKey]
+        return any(parent is not None and parent in self._pending for parent in parents)
+
+    def _remove_covered_by(self, metadata):
+        """Removes pending items that the given season or show will include anyway."""
+        covered = [key for key, pending in self._pending.items()
+                   if metadata.ratingKey in (pending.parentRatingKey, pending.grandparentRatingKey)]
+        for key in covered:
+            log.debug(f'Dropping pending {self._pending[key].type} {key}, it is covered by {metadata.type} {metadata.ratingKey}')
+            del self._pending[key]
+            self._covered.append(key)
@@ -0,0 +1,59 @@
+import os
+import logging
+from .sqliteStore import SQLiteStore
+from .videoHashes import compute_video_hashes, get_hash_names
+
+log = logging.getLogger('plex-sub-downloader')
+
+class HashCache(SQLiteStore):
+    """On-disk cache of the video hashes that subtitle providers search by.
+    Hashes are keyed on the file's path, size, mtime and inode, so each file is only read once until it changes.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS video_hashes (
+            path TEXT NOT NULL,
+            hash_name TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            hash TEXT,
+            PRIMARY KEY (path, hash_name)
+        )""",
+    )
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def get_hashes(self, path, providers, hash_function=compute_video_hashes):
+        """Returns the hashes of the given file that the given providers search by, computing (and storing) any that
+        aren't cached yet or that are out of date.
+        :param str path: path to the video file.
+        :param list providers: names of the subtitle providers to get hashes for.
+        :param callable hash_function: (Optional) function that takes a path and a list of hash names, and returns a dict of 
+        hash names to hashes. Defaults to compute_video_hashes, which reads the file once for all of them.
+        :return: dict[str, str] of hash names to hashes. Hashes that couldn't be computed (ie the file is too small) are left out.
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        hash_names = get_hash_names(providers)
+        rows = self.execute('SELECT hash_name, hash FROM video_hashes WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?', key)
+        hashes = {hash_name: filehash for hash_name, filehash in rows}
+
+        missing = [hash_name for hash_name in hash_names if hash_name not in hashes]
+        with self._lock:
+            if len(missing) == 0:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if len(missing) > 0:
+            log.debug(f'Computing {missing} hashes for {path}')
+            computed = hash_function(path, missing)
+            self.executemany('INSERT OR REPLACE INTO video_hashes (path, size, mtime_ns, inode, hash_name, hash) VALUES (?, ?, ?, ?, ?, ?)',
+                             [key + (hash_name, filehash) for hash_name, filehash in computed.items()])
+            hashes.update(computed)
+
+        return {hash_name: hashes[hash_name] for hash_name in hash_names if hashes.get(hash_name) is not None}
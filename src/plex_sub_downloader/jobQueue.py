@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger('plex-sub-downloader')
+
+# Job priority classes, highest priority first
+INTERACTIVE = 0
+NEW = 1
+BACKFILL = 2
+PRIORITY_NAMES = ['interactive', 'new', 'backfill']
+
+class JobQueue:
+    """A bounded, in-process queue of jobs that is drained by a pool of worker threads.
+    A job is just a callable and the arguments to call it with, so the webhook can hand work
+    off to PlexSubDownloader and respond to Plex right away.
+
+    Every job belongs to a priority class: INTERACTIVE (like setting subtitles for the next episode when someone starts
+    watching), NEW (newly added media) or BACKFILL (library scans and recovered jobs). Workers always take the oldest
+    job of the highest priority class, except that a job that has waited longer than `starvation_timeout` is taken
+    first, so a steady stream of interactive work can't hold up everything else forever. Running jobs are never interrupted.
+    """
+
+    def __init__(self, maxsize=100, workers=1, starvation_timeout=300):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.starvation_timeout = starvation_timeout
+        self._queues = [deque() for name in PRIORITY_NAMES]
+        self._threads = []
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+        self._latency = [_LatencyStats() for name in PRIORITY_NAMES]
+
+    def configure(self, maxsize=100, workers=1, starvation_timeout=300):
+        """Sets the size of the queue and the number of worker threads. Must be called before start().
+        :param int maxsize: maximum number of jobs waiting in the queue. Jobs put on a full queue are dropped.
+        :param int workers: number of worker threads draining the queue.
+        :param float starvation_timeout: seconds a job can wait before it's run ahead of higher priority jobs.
+        """
+        self.maxsize = maxsize
+        self.workers = max(1, workers)
+        self.starvation_timeout = starvation_timeout
+
+    def start(self):
+        """Starts the worker threads."""
+        log.info(f'Starting job queue with {self.workers} workers (max queue size {self.maxsize})')
+        self._stopping = False
+        for i in range(0, self.workers):
+            thread = threading.Thread(target=self._run, name=f'psd-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Tells each worker thread to exit once it has finished its current job, and waits for them.
+        Jobs still waiting in the queue are discarded.
+        :param float timeout: (Optional) seconds to wait for each worker thread.
+        """
+        log.info("Stopping job queue")
+        with self._lock:
+            self._stopping = True
+            self._available.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def put(self, func, *args, priority=NEW):
+        """Adds a job to the queue without blocking.
+        :param callable func: the function to call.
+        :param args: arguments to call func with.
+        :param int priority: (Optional) the job's priority class, one of INTERACTIVE, NEW or BACKFILL. Defaults to NEW.
+        :return: True if the job was queued, False if the queue was full and the job was dropped.
+        """
+        with self._lock:
+            if self._depth() >= self.maxsize:
+                self.dropped += 1
+                log.warning(f'Job queue is full ({self.maxsize} jobs), dropping job {func.__name__}')
+                return False
+
+            self._queues[priority].append((time.monotonic(), func, args))
+            self.enqueued += 1
+            self._available.notify()
+        return True
+
+    def depth(self):
+        """Returns the number of jobs waiting in the queue."""
+        with self._lock:
+            return self._depth()
+
+    def stats(self):
+        """Returns a dict of counters describing the state of the queue, and the wait and run times of each priority class."""
+        with self._lock:
+            return {
+                'depth': self._depth(),
+                'max_size': self.maxsize,
+                'workers': len(self._threads),
+                'enqueued': self.enqueued,
+                'dropped': self.dropped,
+                'processed': self.processed,
+                'failed': self.failed,
+                'priorities': {name: dict(self._latency[priority].stats(), depth=len(self._queues[priority]))
+                               for priority, name in enumerate(PRIORITY_NAMES)},
+            }
+
+    def _depth(self):
+        return sum(len(q) for q in self._queues)
+
+    def _next_job(self):
+        """Takes the next job off the queue. Must be called while holding the lock.
+        :return: tuple of (priority, enqueued time, func, args), or None if the queue is empty.
+        """
+        waiting = [priority for priority, q in enumerate(self._queues) if len(q) > 0]
+        if len(waiting) == 0:
+            return None
+
+        now = time.monotonic()
+        starved = [priority for priority in waiting if now - self._queues[priority][0][0] >= self.starvation_timeout]
+        if len(starved) > 0:
+            # of the jobs that have waited too long, run the one that has waited the longest
+            priority = min(starved, key=lambda p: self._queues[p][0][0])
+        else:
+            priority = waiting[0]
+        return (priority,) + self._queues[priority].popleft()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                job = self._next_job()
+                while job is None and not self._stopping:
+                    self._available.wait()
+                    job = self._next_job()
+                if self._stopping:
+                    break
+
+            priority, enqueued, func, args = job
+            started = time.monotonic()
+            try:
+                func(*args)
+                with self._lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                log.exception(f'Error while running job {func.__name__}: {e}')
+            finally:
+                with self._lock:
+                    self._latency[priority].record(started - enqueued, time.monotonic() - started)
+
+
+class _LatencyStats:
+    """Keeps track of how long the jobs of a priority class wait in the queue and take to run."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self.total_run = 0
+        self.max_run = 0
+
+    def record(self, wait, run):
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += run
+        self.max_run = max(self.max_run, run)
+
+    def stats(self):
+        return {
+            'jobs': self.count,
+            'avg_wait': self.total_wait / self.count if self.count > 0 else 0,
+            'max_wait': self.max_wait,
+            'avg_run': self.total_run / self.count if self.count > 0 else 0,
+            'max_run': self.max_run,
+        }
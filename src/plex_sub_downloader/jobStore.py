@@ -0,0 +1,147 @@
+import time
+import logging
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+DEFAULT_RETRY_BACKOFF = [300, 3600, 21600]
+
+class JobStore(SQLiteStore):
+    """On-disk record of the videos that PlexSubDownloader has been asked to find subtitles for, so that work that was
+    queued up (or running) when the process stopped can be picked up again when it starts back up.
+    There is one job per rating key and language, which moves from pending to running to done (or failed), so adding a
+    language to `languages` adds jobs for it without touching the jobs for the other languages.
+    Failed jobs are retried following the `retry_backoff` schedule (by default after 5 minutes, 1 hour and then 6 hours),
+    after which they're left failed until the video is added again (like by `scan-library`).
+    Finished jobs are kept for `retention` seconds so they show up in the status counts.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS video_jobs (
+            rating_key INTEGER NOT NULL,
+            language TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (rating_key, language)
+        )""",
+        'CREATE INDEX IF NOT EXISTS video_jobs_status ON video_jobs (status)',
+    )
+
+    def __init__(self, path, retention=604800, retry_backoff=DEFAULT_RETRY_BACKOFF):
+        """
+        :param str path: path to the database file.
+        :param float retention: seconds to keep finished jobs for. Defaults to 1 week.
+        :param list retry_backoff: list of seconds to wait before retrying a job after its 1st, 2nd, 3rd... failure.
+        Jobs aren't retried after failing more times than there are values.
+        """
+        super().__init__(path)
+        self.retention = retention
+        self.retry_backoff = retry_backoff
+
+    def add(self, ratingKeys, languages):
+        """Records pending jobs for the given rating keys and languages. Jobs that are already pending or running are left
+        alone, so adding the same video twice doesn't queue it up twice.
+        :param list ratingKeys: list of int rating keys.
+        :param list languages: list of language codes being requested.
+        :return: list of the rating keys that had a job added (or re-added, if its last job had finished) for any language.
+        """
+        if len(ratingKeys) == 0 or len(languages) == 0:
+            return []
+
+        with self._lock:
+            placeholders = ','.join('?' for k in ratingKeys)
+            rows = self.execute(f'SELECT rating_key, language FROM video_jobs WHERE status IN (?, ?) AND rating_key IN ({placeholders})',
+                                [PENDING, RUNNING] + list(ratingKeys))
+            active = set(rows)
+            jobs = [(key, language) for key in dict.fromkeys(ratingKeys) for language in dict.fromkeys(languages)
+                    if (key, language) not in active]
+
+            now = time.time()
+            self.executemany("""INSERT INTO video_jobs (rating_key, language, status, created, updated) VALUES (?, ?, ?, ?, ?)
+                                ON CONFLICT (rating_key, language) DO UPDATE SET status = excluded.status, attempts = 0,
+                                error = NULL, created = excluded.created, updated = excluded.updated""",
+                             [(key, language, PENDING, now, now) for key, language in jobs])
+        return list(dict.fromkeys(key for key, language in jobs))
+
+    def start(self, ratingKeys, languages):
+        """Marks the jobs for the given rating keys and languages as running."""
+        if len(ratingKeys) == 0:
+            return
+        self.executemany('UPDATE video_jobs SET status = ?, attempts = attempts + 1, updated = ? WHERE rating_key = ? AND language = ?',
+                         [(RUNNING, time.time(), key, language) for key in ratingKeys for language in languages])
+
+    def finish(self, ratingKeys, languages, error=None):
+        """Marks the jobs for the given rating keys and languages as done, or as failed if an error is given.
+        :param list ratingKeys: list of int rating keys.
+        :param list languages: list of language codes.
+        :param str error: (Optional) description of what went wrong.
+        """
+        if len(ratingKeys) == 0:
+            return
+        status = DONE if error is None else FAILED
+        self.executemany('UPDATE video_jobs SET status = ?, error = ?, updated = ? WHERE rating_key = ? AND language = ?',
+                         [(status, error, time.time(), key, language) for key in ratingKeys for language in languages])
+
+    def recover(self, languages):
+        """Called on startup. Jobs that were still running when the process stopped are moved back to pending, and
+        finished jobs older than the retention period are deleted (except failed jobs that will still be retried).
+        Pending jobs for languages that are no longer requested are marked as failed.
+        :param list languages: list of language codes currently being requested.
+        :return: list of the rating keys of every pending job.
+        """
+        if len(languages) == 0:
+            return []
+
+        with self._lock:
+            now = time.time()
+            placeholders = ','.join('?' for l in languages)
+            self.execute(f"""DELETE FROM video_jobs WHERE updated < ? AND (status = ? OR (status = ? AND
+                             (attempts > ? OR language NOT IN ({placeholders}))))""",
+                         [now - self.retention, DONE, FAILED, len(self.retry_backoff)] + list(languages))
+            self.execute('UPDATE video_jobs SET status = ?, updated = ? WHERE status = ?', (PENDING, now, RUNNING))
+            self.execute(f'UPDATE video_jobs SET status = ?, error = ?, updated = ? WHERE status = ? AND language NOT IN ({placeholders})',
+                         [FAILED, 'Language is no longer requested', now, PENDING] + list(languages))
+            rows = self.execute('SELECT rating_key FROM video_jobs WHERE status = ? GROUP BY rating_key ORDER BY MIN(created)', (PENDING,))
+        return [row[0] for row in rows]
+
+    def retry(self, languages):
+        """Moves the failed jobs whose backoff has passed back to pending.
+        :param list languages: list of language codes currently being requested.
+        :return: list of the rating keys of the jobs that were moved back to pending.
+        """
+        if len(languages) == 0 or len(self.retry_backoff) == 0:
+            return []
+
+        with self._lock:
+            now = time.time()
+            placeholders = ','.join('?' for l in languages)
+            rows = self.execute(f"""SELECT rating_key, language, attempts, updated FROM video_jobs
+                                   WHERE status = ? AND attempts <= ? AND language IN ({placeholders}) ORDER BY created""",
+                                [FAILED, len(self.retry_backoff)] + list(languages))
+            jobs = [(key, language) for key, language, attempts, updated in rows if now >= updated + self.get_backoff(attempts)]
+            self.executemany('UPDATE video_jobs SET status = ?, updated = ? WHERE rating_key = ? AND language = ?',
+                             [(PENDING, now, key, language) for key, language in jobs])
+        if len(jobs) > 0:
+            log.debug(f'Retrying {len(jobs)} failed jobs')
+        return list(dict.fromkeys(key for key, language in jobs))
+
+    def get_backoff(self, attempts):
+        """Returns the number of seconds to wait before retrying a job that has been tried the given number of times."""
+        return self.retry_backoff[min(max(attempts, 1), len(self.retry_backoff)) - 1]
+
+    def counts(self):
+        """Returns the number of jobs (one per video and language) in each status.
+        :return: dict[str, int]
+        """
+        counts = {PENDING: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for status, count in self.execute('SELECT status, COUNT(*) FROM video_jobs GROUP BY status'):
+            counts[status] = count
+        return counts
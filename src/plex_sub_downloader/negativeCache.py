@@ -0,0 +1,75 @@
+import time
+import logging
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+DEFAULT_BACKOFF = [3600, 21600, 86400, 604800]
+
+class NegativeResultCache(SQLiteStore):
+    """On-disk record of searches that didn't find any subtitles, so that videos that don't have subtitles yet aren't
+    searched again on every play event or library scan. Each miss pushes the next search further out, following the
+    `backoff` schedule (by default 1 hour, 6 hours, 1 day, and then 1 week), and a successful search clears the record.
+    Entries are keyed on the subliminal video's identity (its name, which is the path of the video file) and the language.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS negative_results (
+            video TEXT NOT NULL,
+            language TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_searched REAL NOT NULL,
+            PRIMARY KEY (video, language)
+        )""",
+    )
+
+    def __init__(self, path, backoff=DEFAULT_BACKOFF):
+        """
+        :param str path: path to the database file.
+        :param list backoff: list of seconds to wait before searching again after the 1st, 2nd, 3rd... miss.
+        The last value is used for every miss after that.
+        """
+        super().__init__(path)
+        self.backoff = backoff
+
+    def get_suppressed_languages(self, video, languages):
+        """Returns the languages that shouldn't be searched for yet for the given video.
+        :param str video: the video's identity.
+        :param list languages: list of language codes.
+        :return: list of language codes that are still backing off.
+        """
+        if len(languages) == 0:
+            return []
+
+        placeholders = ','.join('?' for l in languages)
+        rows = self.execute(f'SELECT language, attempts, last_searched FROM negative_results WHERE video = ? AND language IN ({placeholders})',
+                            [video] + list(languages))
+        now = time.time()
+        suppressed = [language for language, attempts, last_searched in rows if now < last_searched + self.get_backoff(attempts)]
+        return [language for language in languages if language in suppressed]
+
+    def get_backoff(self, attempts):
+        """Returns the number of seconds to wait after the given number of searches that didn't find anything."""
+        return self.backoff[min(attempts, len(self.backoff)) - 1]
+
+    def record_misses(self, video, languages):
+        """Records that a search for the given languages didn't find any subtitles.
+        :param str video: the video's identity.
+        :param list languages: list of language codes.
+        """
+        if len(languages) == 0:
+            return
+        log.debug(f'Recording that no subtitles were found for {video} in languages {languages}')
+        now = time.time()
+        self.executemany("""INSERT INTO negative_results (video, language, attempts, last_searched) VALUES (?, ?, 1, ?)
+                            ON CONFLICT (video, language) DO UPDATE SET attempts = attempts + 1, last_searched = excluded.last_searched""",
+                         [(video, language, now) for language in languages])
+
+    def clear(self, video, languages):
+        """Clears any record of missed searches for the given languages.
+        :param str video: the video's identity.
+        :param list languages: list of language codes.
+        """
+        if len(languages) == 0:
+            return
+        self.executemany('DELETE FROM negative_results WHERE video = ? AND language = ?', [(video, language) for language in languages])
@@ -1,20 +1,52 @@
+import io
 import os
 import logging
 import plexapi
 from plexapi.server import PlexServer
+from plexapi.myplex import MyPlexAccount
+from plexapi.exceptions import Unauthorized
 from plexapi.video import Video, Episode, EpisodeSession
 from plexapi.library import LibrarySection
 from plexapi.media import SubtitleStream
 import socket
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
 
 log = logging.getLogger('plex-sub-downloader')
 
+# The local account id of the server's owner
+ADMIN_ACCOUNT_ID = 1
+
+# The user of a play session, as given in the session XML
+SessionUser = namedtuple('SessionUser', ['id', 'title'])
+
 class PlexHelper:
 
-    def __init__(self, baseurl, token, host="0.0.0.0", port=None):
-        self.plexServer = PlexServer(baseurl=baseurl, token=token)
+    def __init__(self, baseurl, token, host="0.0.0.0", port=None, session_cache_ttl=5, account_cache_ttl=3600, session=None, timeout=None):
+        """
+        :param str baseurl: base url of the Plex server.
+        :param str token: Plex auth token.
+        :param str host: the webhook's host.
+        :param int port: the webhook's port.
+        :param float session_cache_ttl: seconds to reuse the list of active play sessions for.
+        :param float account_cache_ttl: seconds to reuse the Plex account and other users' logins for.
+        :param requests.Session session: (Optional) session to send every request through (see plexSession.build_plex_session()).
+        :param timeout: (Optional) request timeout in seconds, or a tuple of (connect timeout, read timeout).
+        """
+        self.plexServer = PlexServer(baseurl=baseurl, token=token, session=session, timeout=timeout)
         self.host = host
         self.port = port
+        self.session_cache_ttl = session_cache_ttl
+        self._sessions = {}
+        self._sessions_fetched_at = None
+        self._sessions_lock = threading.Lock()
+        self.account_cache_ttl = account_cache_ttl
+        self._admin_account = None
+        self._admin_account_expires = 0
+        self._user_servers = {}
+        self._accounts_lock = threading.Lock()
 
     def get_video_item_from_event(self, event):
          # if Metadata.type == "show", then the metadata key looks like
@@ -24,60 +56,155 @@ class PlexHelper:
         return self.get_video_item(key)
 
     def get_video_item(self, key):
+        """Fetches the item with the given metadata key. Fetching an item by its key returns its media, parts and streams, 
+        so it doesn't need to be reloaded.
+        :param str key:
+        :return plexapi.video.Video | None:
+        """
         key = key.replace("/children", "")
         try:
             video = self.plexServer.fetchItem(ekey=key)
-            video.reload()
             return video
         except Exception as e:
             log.error(f'Error while trying to retrieve video with key {key}')
             log.error(e)
             return None
         
-    def get_next_episode(self, key):
-        """A convenience function that attempts to find the next episode for the given video key.
+    def get_video_items(self, ratingKeys, chunk_size=50):
+        """Fetches the items with the given rating keys, `chunk_size` at a time from /library/metadata/<key1,key2,...>.
+        Like get_video_item(), the items come back with their media, parts and streams.
+        :param list ratingKeys: list of int rating keys.
+        :param int chunk_size: number of items to fetch per request.
+        :return list: the items that could be found, in the same order as ratingKeys.
+        """
+        items = {}
+        for i in range(0, len(ratingKeys), chunk_size):
+            keys = ratingKeys[i:i + chunk_size]
+            try:
+                for item in self.plexServer.fetchItems(keys):
+                    items[item.ratingKey] = item
+            except Exception as e:
+                log.error(f'Error while trying to retrieve videos with keys {keys}')
+                log.error(e)
+        return [items[key] for key in ratingKeys if key in items]
+
+    def load_streams(self, videos, chunk_size=50):
+        """Makes sure that each of the given videos has its media streams loaded.
+        Library listings (like Show.episodes()) don't include streams, so instead of reloading each video one by one,
+        videos missing streams are fetched `chunk_size` at a time from /library/metadata/<key1,key2,...>.
+        Videos that already have streams are left alone.
+        :param list videos: list of plexapi.video.Video objects.
+        :param int chunk_size: number of videos to fetch per request.
+        :return list: the videos, in the same order, with any that were missing streams replaced by fully loaded ones.
+        """
+        missing = [video for video in videos if not self.has_streams(video)]
+        if len(missing) == 0:
+            return videos
+        
+        log.debug(f"Fetching streams for {len(missing)} of {len(videos)} videos")
+        loaded = {item.ratingKey: item for item in self.get_video_items([video.ratingKey for video in missing], chunk_size)}
+
+        results = []
+        for video in videos:
+            if video.ratingKey in loaded:
+                video = loaded[video.ratingKey]
+            elif not self.has_streams(video):
+                video.reload()
+            results.append(video)
+        return results
+
+    def has_streams(self, video):
+        """Returns True if every MediaPart of the given video has its streams loaded.
+        :param plexapi.video.Video video:
+        :return bool:
+        """
+        parts = list(video.iterParts())
+        return len(parts) > 0 and all(len(part.streams) > 0 for part in parts)
+
+    def get_subtitle_streams(self, video):
+        """Returns the SubtitleStreams of every MediaPart of the given video.
+        Unlike Video.subtitleStreams(), this doesn't reload the video if it was loaded from a listing,
+        so load_streams() should be called first for videos that might be missing streams.
+        :param plexapi.video.Video video:
+        :return list[plexapi.media.SubtitleStream]:
+        """
+        streams = []
+        for part in video.iterParts():
+            streams += part.subtitleStreams()
+        return streams
+
+    def get_next_episodes(self, key, count=1):
+        """Finds the episodes that come after the given video in its show.
+        The whole show is listed with a single request, and the following episodes are picked out of that listing
+        and loaded with their streams.
             :param str key:
-            :return plexapi.video.Episode | None:
+            :param int count: (Optional) the number of episodes to look ahead. Defaults to 1.
+            :return list[plexapi.video.Episode]: the next episodes, in order. Empty if the video isn't an episode or is the last one.
         """
         video = self.get_video_item(key)
         if video is None or type(video) is not Episode:
-            return None
+            return []
         
-        log.debug(f"Searching for next episode for video {video.key}")
-        show = video.show()
-
-        nextEpisode = None
-
-        #show.episode throws an exception if it can't find the video, because plexapi tries to parse a non-existent response
-        try:
-            nextEpisode = show.episode(season=int(video.seasonNumber), episode=int(video.episodeNumber) + 1)
-        except:
-            log.debug(f"Next episode in season not found, checking for first episode of next season")
-            try:
-                nextEpisode = show.episode(season=int(video.seasonNumber) + 1, episode = 1)
-            except:
-                log.debug(f"First episode of next season not found. This must be the last episode of the show(?)")
-                return None
-        finally:
-            if nextEpisode is not None:
-                nextEpisode.reload()
-                log.debug(f"Found next episode for video {video.key}: {nextEpisode.key}")
-            return nextEpisode
+        log.debug(f"Searching for next {count} episodes for video {video.key}")
+        episodes = video.show().episodes()
+        position = next((i for i, episode in enumerate(episodes) if episode.ratingKey == video.ratingKey), None)
+        if position is None:
+            log.debug(f"Video {video.key} not found in its show's episodes")
+            return []
+
+        nextEpisodes = episodes[position + 1:position + 1 + count]
+        if len(nextEpisodes) == 0:
+            log.debug(f"No episodes found after video {video.key}. This must be the last episode of the show(?)")
+            return []
+        
+        log.debug(f"Found next episodes for video {video.key}: {[episode.key for episode in nextEpisodes]}")
+        return self.load_streams(nextEpisodes)
 
     
     def get_session_for_play_event(self, event):
         """Searches for a currently active session matching the given event.
+        Sessions are looked up in a snapshot of /status/sessions that's shared between events and refreshed at most
+        once every `session_cache_ttl` seconds. If the session isn't in the snapshot (it may have started after the
+        snapshot was taken), the snapshot is refreshed once more.
         :param PlexWebhookEvent event:
         :return plexapi.video.PlexSession | None:
         """
         log.debug(f"Searching for active session for event {event.Metadata.guid}")
-        sessions = self.plexServer.sessions()
-        for session in sessions:
-            if session.user.id == event.Account.id and session.guid == event.Metadata.guid:
-                log.debug(f"Found active session matching event {event.Metadata.guid}")
-                return session
+        key = (str(event.Account.id), event.Metadata.guid)
+        requestedAt = time.monotonic()
+
+        session = self.get_sessions(max_age=self.session_cache_ttl).get(key)
+        if session is None:
+            session = self.get_sessions(fetched_after=requestedAt).get(key)
         
-        return None
+        if session is not None:
+            log.debug(f"Found active session matching event {event.Metadata.guid}")
+        return session
+
+    def get_sessions(self, max_age=None, fetched_after=None):
+        """Returns a snapshot of the currently active sessions, indexed by (account id, guid).
+        The snapshot is only fetched again if it's older than `max_age` seconds, or if it was fetched before `fetched_after`.
+        Concurrent callers share a single fetch.
+        :param float max_age: (Optional) maximum age of the snapshot in seconds.
+        :param float fetched_after: (Optional) time.monotonic() value the snapshot must have been fetched after.
+        :return dict[tuple, plexapi.base.PlexSession]:
+        """
+        with self._sessions_lock:
+            fetchedAt = self._sessions_fetched_at
+            stale = (fetchedAt is None 
+                     or (max_age is not None and time.monotonic() - fetchedAt > max_age)
+                     or (fetched_after is not None and fetchedAt < fetched_after))
+            if stale:
+                fetchedAt = time.monotonic()
+                sessions = {}
+                for session in self.plexServer.sessions():
+                    # _userId is the local account id from the session XML, which is what webhook events send.
+                    # session.user would look the account up on plex.tv for every session.
+                    sessions[(str(session._userId), session.guid)] = session
+                self._sessions = sessions
+                self._sessions_fetched_at = fetchedAt
+                log.debug(f"Fetched {len(sessions)} active sessions")
+            return self._sessions
 
     def get_selected_subtitles_for_play_session(self, session):
         """Finds the selected SubtitleStream object (if any) for the given session.
@@ -98,33 +225,65 @@ class PlexHelper:
                         return stream
         return None
 
+    def upload_subtitles(self, video, filename, content):
+        """Uploads subtitles to the given video's metadata straight from memory.
+        This does the same thing as Video.uploadSubtitles(), which needs the subtitles to be in a file.
+        :param plexapi.video.Video video:
+        :param str filename: the subtitle file's name. Its extension is used as the subtitle format.
+        :param bytes content: the subtitle file's contents.
+        """
+        url = f'{video.key}/subtitles'
+        params = {'title': filename, 'format': os.path.splitext(filename)[1][1:]}
+        headers = {'Accept': 'text/plain, */*'}
+        self.plexServer.query(url, self.plexServer._session.post, data=io.BytesIO(content), params=params, headers=headers)
+
+    def get_session_user(self, session):
+        """Returns the user of the given play session, without looking them up on plex.tv.
+        :param plexapi.base.PlexSession session:
+        :return SessionUser:
+        """
+        return SessionUser(id=session._userId, title=session._username)
+
     def select_video_subtitles_for_user(self, video, user, subtitle_to_match):
         """A convenience function to find and set subtitles for the given video and user that best match the given SubtitleStream.
         :param plexapi.video.Video video:
-        :param plexapi.myplex.MyPlexAccount user:
+        :param SessionUser user:
         :param plexapi.media.SubtitleStream subtitle_to_match:
         """
 
         matching_subtitles = self.find_matching_subtitles_for_video(subtitle_to_match=subtitle_to_match, video=video)
 
-        ps = self.switch_user(user)
         for video_part_id, matching_subtitle in matching_subtitles.items():
             log.debug(f"Setting subtitles {matching_subtitle.id} for user {user.id} on MediaPart {video_part_id}")
             query_url = f"/library/parts/{video_part_id}?subtitleStreamID={matching_subtitle.id}"
-            ps.query(query_url, method=ps._session.put)
+            self.put_as_user(user, query_url)
 
     def unset_video_subtitles_for_user(self, video, user):
         """A convenience function to unset the subtitle selections for the given video and given user.
         :param plexapi.media.Video video:
-        :param plexapi.myplex.MyPlexAccount user:
+        :param SessionUser user:
         """
 
-        ps = self.switch_user(user)
         for media in video.media:
             for part in media.parts:
                 log.debug(f"Unsetting subtitle selection for user {user.title} on MediaPart {part.id}")
                 query_url = f"/library/parts/{part.id}?subtitleStreamID=0"
-                ps.query(query_url, method=ps._session.put)
+                self.put_as_user(user, query_url)
+
+    def put_as_user(self, user, query_url):
+        """Sends a PUT request to the server as the given user. If the user's cached token has stopped working,
+        it's fetched again and the request is retried once.
+        :param SessionUser user:
+        :param str query_url:
+        """
+        ps = self.switch_user(user)
+        try:
+            ps.query(query_url, method=ps._session.put)
+        except Unauthorized:
+            log.debug(f"Token for user {user.title} was rejected, switching to them again")
+            self.forget_user(user)
+            ps = self.switch_user(user)
+            ps.query(query_url, method=ps._session.put)
 
     def find_matching_subtitles_for_video(self, subtitle_to_match, video):
         """Find subtitles on each MediaPart of the given video that best matches the given subtitle from a different video.
@@ -182,18 +341,105 @@ class PlexHelper:
         return score
     
     def switch_user(self, user):
-        """Wrapper function for calling PlexServer.switchUser(). 
-        If user is the admin account, then PlexServer.switchUser() will raise an exception, 
-        so the default plexServer object will be returned.
-        :param plexapi.myplex.MyPlexAccount user:
+        """Returns a PlexServer logged in as the given user. 
+        If user is the admin account, then PlexServer.switchUser() would raise an exception, 
+        so the default plexServer object is returned. Other users' PlexServer objects are kept for `account_cache_ttl`
+        seconds, since switching users takes several requests to plex.tv.
+        :param SessionUser user:
         :return plexapi.server.PlexServer:
         """
 
-        admin = self.plexServer.myPlexAccount()
-        if user.id == admin.id:
+        if user.id == ADMIN_ACCOUNT_ID:
             return self.plexServer
-        else: 
-            return self.plexServer.switchUser(user.title)
+
+        with self._accounts_lock:
+            cached = self._user_servers.get(user.title)
+            if cached is not None and time.monotonic() < cached[1]:
+                return cached[0]
+
+        log.debug(f"Switching to user {user.title}")
+        myPlexUser = self.get_admin_account().user(user.title)
+        userServer = self.plexServer.switchUser(myPlexUser)
+        with self._accounts_lock:
+            self._user_servers[user.title] = (userServer, time.monotonic() + self.account_cache_ttl)
+        return userServer
+
+    def forget_user(self, user):
+        """Drops the cached PlexServer object for the given user.
+        :param SessionUser user:
+        """
+        with self._accounts_lock:
+            self._user_servers.pop(user.title, None)
+
+    def get_admin_account(self):
+        """Returns the MyPlexAccount that owns the server. The account is fetched from plex.tv once and then reused 
+        for `account_cache_ttl` seconds.
+        :return plexapi.myplex.MyPlexAccount:
+        """
+        with self._accounts_lock:
+            if self._admin_account is not None and time.monotonic() < self._admin_account_expires:
+                return self._admin_account
+
+        account = MyPlexAccount(token=self.plexServer._token, session=self.plexServer._session, timeout=self.plexServer._timeout)
+        with self._accounts_lock:
+            self._admin_account = account
+            self._admin_account_expires = time.monotonic() + self.account_cache_ttl
+        return account
+
+    def get_library_sections(self, sections=None):
+        """Returns the library sections with the given titles or ids, or all sections if none are given.
+        :param list sections: (Optional) list of section titles or ids.
+        :return: list[plexapi.library.LibrarySection]
+        """
+        allSections = self.plexServer.library.sections()
+        if sections is None or len(sections) == 0:
+            return allSections
+        
+        sections = [str(section) for section in sections]
+        matchingSections = [section for section in allSections if section.title in sections or str(section.key) in sections]
+        if len(matchingSections) < len(sections):
+            log.warning(f'Some of the library sections {sections} could not be found')
+        return matchingSections
+
+    def iter_section_videos(self, section, updated_since=None, page_size=200):
+        """Yields the movies or episodes in the given library section one page at a time, oldest `updatedAt` first,
+        so that a large library never has to be held in memory all at once.
+        Pages are requested by `updatedAt` rather than by offset, so items that are updated while the section is being
+        listed (like by uploading subtitles to them) can't shift later items out from under the next page. Items that
+        have already been yielded (ie because they were updated and moved further along) are left out.
+        :param plexapi.library.LibrarySection section: a movie or show section.
+        :param int updated_since: (Optional) timestamp, only items updated at or after this time are returned.
+        :param int page_size: number of items to request from Plex at a time.
+        :return: generator of lists of plexapi.video.Movie or plexapi.video.Episode objects.
+        """
+        libtype = 'episode' if section.type == 'show' else 'movie'
+        cursor = updated_since
+        atCursor = 0 # number of items already listed that were updated at `cursor` exactly
+        seen = set()
+        while True:
+            filters = {}
+            if cursor is not None:
+                # `>>` is strictly after, so step back a second to include items updated at the cursor itself
+                filters['updatedAt>>'] = datetime.fromtimestamp(cursor - 1)
+
+            # Items updated at the cursor that were already listed come back first, so ask for enough to get past them
+            size = page_size + atCursor
+            items = section.search(libtype=libtype, sort='updatedAt:asc', filters=filters,
+                                   container_start=0, container_size=size, maxresults=size)
+            page = [item for item in items if item.ratingKey not in seen]
+            seen.update(item.ratingKey for item in page)
+
+            timestamps = [int(item.updatedAt.timestamp()) if item.updatedAt is not None else 0 for item in items]
+            if len(timestamps) > 0 and (cursor is None or max(timestamps) > cursor):
+                cursor = max(timestamps)
+                atCursor = timestamps.count(cursor)
+            else:
+                atCursor = len(items)
+
+            if len(page) > 0:
+                yield page
+            if len(items) < size:
+                return
 
     def check_library_permissions(self, sectionId=None):
         """Checks whether the application has permissions to read/write to the base paths of each section 
@@ -233,7 +479,7 @@ class PlexHelper:
         webhookUrl = self.get_webhook_url()
         log.info(f'Checking if webhook url {webhookUrl} has been added to Plex...')
 
-        plexAccount = self.plexServer.myPlexAccount()
+        plexAccount = self.get_admin_account()
         webhooks = plexAccount.webhooks()
 
         if webhookUrl in webhooks:
@@ -245,7 +491,7 @@ class PlexHelper:
     
     def add_webhook_to_plex(self):
         webhookUrl = self.get_webhook_url()
-        plexAccount = self.plexServer.myPlexAccount()
+        plexAccount = self.get_admin_account()
         log.info(f'Attempting to add webhook url {webhookUrl} to Plex...')
         webhooks = plexAccount.addWebhook(webhookUrl)
         if webhookUrl in webhooks:
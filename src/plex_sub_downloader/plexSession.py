@@ -0,0 +1,68 @@
+import re
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger('plex-sub-downloader')
+
+def build_plex_session(pool_size=4, max_retries=3, stats=None):
+    """Builds the requests.Session that every request to Plex (and plex.tv) goes through.
+    Connections are kept alive and pooled, with room for `pool_size` connections per host, so that worker threads don't
+    have to open a new connection for every request. Requests that fail to connect, have their connection reset, or get a
+    502, 503 or 504 back are retried up to `max_retries` times with a short backoff. POST requests are never retried.
+    :param int pool_size: maximum number of connections to keep open to each host.
+    :param int max_retries: maximum number of times to retry a request.
+    :param RequestStats stats: (Optional) collects the latency of every request.
+    :return: requests.Session
+    """
+    retry = Retry(total=max_retries, connect=max_retries, read=max_retries, status=max_retries,
+                  status_forcelist=(502, 503, 504), allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                  backoff_factor=0.5, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if stats is not None:
+        session.hooks['response'].append(stats.record_response)
+    return session
+
+
+class RequestStats:
+    """Counts requests and their latencies per endpoint. Endpoints are the request method and path, with ids replaced
+    by `{id}` (ie `GET /library/metadata/{id}/children`), so that requests for different items are counted together.
+    Latency is the time until the response headers arrived, as measured by requests.
+    """
+
+    _ID_PATTERN = re.compile(r'/\d+(,\d+)*(?=/|$)')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record_response(self, response, *args, **kwargs):
+        endpoint = f'{response.request.method} {self._ID_PATTERN.sub("/{id}", urlparse(response.request.url).path)}'
+        elapsed = response.elapsed.total_seconds()
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = {'requests': 0, 'errors': 0, 'total_time': 0, 'max_time': 0}
+                self._endpoints[endpoint] = stats
+            stats['requests'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if response.status_code >= 400:
+                stats['errors'] += 1
+
+    def stats(self):
+        """Returns a dict of endpoints to their request count, error count, and average and max latency in seconds."""
+        with self._lock:
+            return {endpoint: {'requests': stats['requests'],
+                               'errors': stats['errors'],
+                               'avg_time': stats['total_time'] / stats['requests'],
+                               'max_time': stats['max_time']}
+                    for endpoint, stats in self._endpoints.items()}
@@ -4,26 +4,39 @@ import json
 import jsonschema
 import sys
 from waitress import serve
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify
 import logging
 from .PlexWebhookEvent import PlexWebhookEvent
 from .PlexSubDownloader import PlexSubDownloader
+from .jobQueue import JobQueue
 from importlib.metadata import version
 
 log = logging.getLogger('plex-sub-downloader')
 psd = PlexSubDownloader() 
+jobQueue = JobQueue()
 APP = Flask(__name__)
 
 @APP.route('/webhook', methods=['POST'])
 def respond():
     """
-    Handle POST request sent from Plex server
+    Handle POST request sent from Plex server.
+    The event is queued up to be handled by a worker thread, so that Plex isn't kept waiting.
     """
     data = json.loads(request.form.get('payload'))
     
     event = PlexWebhookEvent(data)
-    psd.handle_webhook_event(event)
-    return Response(status=200)
+    if psd.submit_webhook_event(event) == False:
+        return Response(status=503)
+    return Response(status=202)
+
+@APP.route('/status', methods=['GET'])
+def status():
+    """
+    Returns the current state of the job queue and caches.
+    """
+    status = psd.get_status()
+    status['queue'] = jobQueue.stats()
+    return jsonify(status)
 
 
 def main():
@@ -45,6 +58,14 @@ def main():
 
     checkvideo_parser = subparsers.add_parser('check-video', description='Manually check the given video key for mising subtitles.')
     checkvideo_parser.add_argument('video_key', help="The metadata key of a Movie, Episode, Season, or Show (example \"/library/metadata/42069\")")
+
+    warmhash_parser = subparsers.add_parser('warm-hash-cache', description='Hashes every video file in the library ahead of time, so that subtitle searches don\'t have to.')
+    warmhash_parser.add_argument('-s', '--section', action='append', dest='sections', help="Title or id of a library section to hash. Can be given more than once. Defaults to all sections.")
+    
+    scanlibrary_parser = subparsers.add_parser('scan-library', description='Checks every movie and episode in the library for missing subtitles. Only items added or updated since the last scan are checked, unless --full is given.')
+    scanlibrary_parser.add_argument('-s', '--section', action='append', dest='sections', help="Title or id of a library section to scan. Can be given more than once. Defaults to all sections.")
+    scanlibrary_parser.add_argument('--full', action='store_true', help="Check every item, instead of only items added or updated since the last scan.")
+    scanlibrary_parser.add_argument('--batch-size', type=int, default=50, dest='batch_size', help="Number of videos missing subtitles to search for at once. Defaults to 50.")
     
     parser.set_defaults(debug=False)
 
@@ -78,12 +99,26 @@ def main():
     if args.command == "start-webhook":
         log.info("plex-sub-downloader starting up")
         checkPlexConfiguration()
+        startJobQueue(config)
+        psd.recover_jobs()
+        psd.start_reconciler()
         runFlask(config)
         log.info("plex-sub-downloader shutting down")
+        jobQueue.stop()
+        psd.shutdown()
 
     if args.command == "check-video":
         key = args.video_key
         psd.manually_check_video_subtitles(key)
+        psd.shutdown()
+
+    if args.command == "warm-hash-cache":
+        psd.warm_hash_cache(args.sections)
+        psd.shutdown()
+
+    if args.command == "scan-library":
+        psd.scan_library(args.sections, full=args.full, batch_size=args.batch_size)
+        psd.shutdown()
     
 
 def loadConfig(filepath):
@@ -96,6 +131,13 @@ def checkPlexConfiguration():
     if psd.check_webhook_registration() == False:
         psd.add_webhook_to_plex()
 
+def startJobQueue(config):
+    jobQueue.configure(maxsize=config.get('webhook_queue_size', 100), 
+                       workers=config.get('webhook_workers', 2),
+                       starvation_timeout=config.get('webhook_starvation_timeout', 300))
+    jobQueue.start()
+    psd.set_job_queue(jobQueue)
+
 def runFlask(config):
     host = config.get('webhook_host', '127.0.0.1')
     port = config.get('webhook_port', 5000)
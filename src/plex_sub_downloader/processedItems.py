@@ -0,0 +1,54 @@
+import time
+import logging
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+class ProcessedItemStore(SQLiteStore):
+    """On-disk record of the movies and episodes that have already been checked for missing subtitles, and the
+    `updatedAt` time they had when they were checked. The reconciler diffs what Plex reports against this, so that
+    only items that were missed (or that changed since) get checked again.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS processed_items (
+            rating_key INTEGER PRIMARY KEY,
+            updated_at INTEGER NOT NULL,
+            processed_at REAL NOT NULL
+        )""",
+    )
+
+    def get_unprocessed(self, videos):
+        """Returns the given videos that haven't been checked yet, or that were updated after they were checked.
+        :param list videos: list of plexapi.video.Video objects.
+        :return: list of plexapi.video.Video objects.
+        """
+        if len(videos) == 0:
+            return []
+
+        placeholders = ','.join('?' for v in videos)
+        rows = self.execute(f'SELECT rating_key, updated_at FROM processed_items WHERE rating_key IN ({placeholders})',
+                            [video.ratingKey for video in videos])
+        processed = {ratingKey: updatedAt for ratingKey, updatedAt in rows}
+        return [video for video in videos if video.ratingKey not in processed or _get_updated_at(video) > processed[video.ratingKey]]
+
+    def record(self, videos):
+        """Records that the given videos have been checked.
+        :param list videos: list of plexapi.video.Video objects.
+        """
+        if len(videos) == 0:
+            return
+        now = time.time()
+        self.executemany('INSERT OR REPLACE INTO processed_items (rating_key, updated_at, processed_at) VALUES (?, ?, ?)',
+                         [(video.ratingKey, _get_updated_at(video), now) for video in videos])
+
+    def get_latest_updated_at(self):
+        """Returns the latest `updatedAt` timestamp of any checked item, or None if nothing has been checked yet."""
+        rows = self.execute('SELECT MAX(updated_at) FROM processed_items')
+        return rows[0][0]
+
+
+def _get_updated_at(video):
+    if video.updatedAt is None:
+        return 0
+    return int(video.updatedAt.timestamp())
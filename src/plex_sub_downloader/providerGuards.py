@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+
+from subliminal.exceptions import DownloadLimitExceeded, ServiceUnavailable
+
+log = logging.getLogger('plex-sub-downloader')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class TokenBucket:
+    """Limits the rate of requests to a provider. The bucket holds up to `burst` tokens and refills at
+    `requests` tokens every `per` seconds, and each request takes a token.
+    """
+
+    def __init__(self, requests, per=1, burst=None):
+        """
+        :param float requests: number of requests allowed every `per` seconds.
+        :param float per: (Optional) length of the period in seconds. Defaults to 1.
+        :param float burst: (Optional) maximum number of requests that can be made at once after an idle period.
+        Defaults to `requests`.
+        """
+        self.rate = requests / per
+        self.capacity = burst if burst is not None else requests
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline=None):
+        """Takes a token, waiting for one to become available if needed.
+        :param float deadline: (Optional) time.monotonic() value after which to stop waiting.
+        :return: True if a token was taken, False if the deadline would pass before one became available.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def available(self):
+        """Returns the (approximate) number of tokens currently in the bucket."""
+        with self._lock:
+            return min(self.capacity, self._tokens + (time.monotonic() - self._updated) * self.rate)
+
+
+class CircuitBreaker:
+    """Stops sending requests to a provider that keeps failing.
+    After `threshold` failures in a row (or a single response saying the provider's quota has been used up), the circuit
+    opens and the provider is skipped for `cooldown` seconds. After that, the circuit is half open: one request is let
+    through as a probe, and the circuit closes again if it succeeds, or reopens if it fails.
+    """
+
+    def __init__(self, name, threshold=5, cooldown=300):
+        """
+        :param str name: name of the provider, for logging.
+        :param int threshold: number of failures in a row that opens the circuit.
+        :param float cooldown: seconds to skip the provider for once the circuit opens.
+        """
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a request to the provider should be made."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                log.info(f'Letting a request through to provider {self.name} to see if it has recovered')
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def skipping(self):
+        """Returns True if requests to the provider are being skipped right now. Unlike allow(), this doesn't use up
+        the half open probe, so it can be checked before waiting on the provider's concurrency or rate limits.
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return time.monotonic() - self._opened_at < self.cooldown
+            return self.state == HALF_OPEN and self._probing
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CLOSED:
+                log.info(f'Provider {self.name} has recovered')
+            self.state = CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self, error=None):
+        """Records a failed request. Errors that mean the provider is throttling requests open the circuit right away.
+        :param Exception error: (Optional) the error the request failed with.
+        """
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == HALF_OPEN or self.failures >= self.threshold or is_throttled(error):
+                if self.state != OPEN:
+                    log.warning(f'Skipping provider {self.name} for {self.cooldown} seconds after {self.failures} failed requests')
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures}
+
+
+def is_throttled(error):
+    """Returns True if the given error means that the provider is refusing requests for now: a used up download quota,
+    the provider saying it's unavailable, or an HTTP error for a 429 response.
+    """
+    if error is None:
+        return False
+    if isinstance(error, (DownloadLimitExceeded, ServiceUnavailable)):
+        return True
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None) == 429
@@ -0,0 +1,338 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from zipfile import BadZipfile
+
+from rarfile import BadRarFile
+from subliminal.exceptions import AuthenticationError
+from subliminal.extensions import provider_manager, default_providers
+from subliminal.utils import handle_exception
+from .providerGuards import TokenBucket, CircuitBreaker
+
+log = logging.getLogger('plex-sub-downloader')
+
+class PersistentProviderPool:
+    """A long-lived pool of initialized subliminal providers, with roughly the same API as subliminal.core.ProviderPool.
+    Unlike subliminal's ProviderPool, providers are kept logged in between searches, so a busy day of imports
+    only has to log in to each provider once, instead of once (or twice) per video.
+
+    Each thread checks out its own provider instance, so the pool can safely be shared between worker threads.
+    The number of instances of each provider in use at once is capped by `max_concurrency`.
+    Idle providers are kept alive with a no-op request (if the provider supports it), logged back in if their session
+    expires, and logged out once they've been idle for longer than `idle_timeout`.
+
+    Requests to a provider can also be rate limited, by adding a `rate_limit` object (the arguments of a TokenBucket)
+    to its config. A provider that keeps failing is skipped for a while (see CircuitBreaker), so the other providers
+    can keep going without waiting on it.
+    """
+
+    def __init__(self, providers=None, provider_configs=None, idle_timeout=1800, keepalive_interval=600, max_concurrency=2, 
+                 failure_threshold=5, failure_cooldown=300, result_cache=None):
+        """
+        :param list providers: names of the providers to use.
+        :param dict provider_configs: configuration for each provider, passed as keyword arguments when instantiating them.
+        A provider's `rate_limit` is taken out of its config and used to limit its requests instead.
+        :param float idle_timeout: seconds a provider can sit unused before it's logged out.
+        :param float keepalive_interval: seconds between no-op requests to keep an idle provider's session alive.
+        :param max_concurrency: maximum number of requests in flight per provider. Either an int that applies to every provider, 
+        or a dict of provider names to ints (providers missing from the dict get 1).
+        :param int failure_threshold: number of failed requests in a row after which a provider is skipped.
+        :param float failure_cooldown: seconds to skip a failing provider for.
+        :param SearchResultCache result_cache: (Optional) cache of the subtitles each provider has listed for recently searched videos.
+        """
+        self.providers = providers or default_providers
+        provider_configs = provider_configs or {}
+        self.provider_configs = {name: {key: value for key, value in config.items() if key != 'rate_limit'}
+                                 for name, config in provider_configs.items()}
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.result_cache = result_cache
+
+        self._idle = {name: [] for name in self.providers}
+        self._limits = {name: self._get_limit(max_concurrency, name) for name in self.providers}
+        self._semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in self._limits.items()}
+        self._rate_limits = {name: TokenBucket(**config['rate_limit']) 
+                             for name, config in provider_configs.items() if config.get('rate_limit') is not None}
+        self._breakers = {name: CircuitBreaker(name, threshold=failure_threshold, cooldown=failure_cooldown) for name in self.providers}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reaper = None
+
+    def list_subtitles(self, video, languages, timeout=None):
+        """Lists subtitles for the given video with every provider.
+        :param video: subliminal.video.Video object
+        :param languages: set[babelfish.Language]
+        :param float timeout: (Optional) seconds to wait for results before giving up on slow providers.
+        :return: list[subliminal.subtitle.Subtitle]
+        """
+        return self.list_subtitles_videos({video: languages}, timeout=timeout)[video]
+
+    def list_subtitles_videos(self, videos, timeout=None):
+        """Lists subtitles for several videos at once, fanning the search for each video with each provider out over a
+        thread pool. Each provider's concurrency limit still applies, so a slow provider only holds up its own searches.
+        :param videos: dict[subliminal.video.Video, set[babelfish.Language]] the videos to search, and the languages to search for each one.
+        :param float timeout: (Optional) overall seconds to wait for results. Searches that haven't finished by then are abandoned,
+        and whatever results did arrive are returned.
+        :return: dict[subliminal.video.Video, list[subliminal.subtitle.Subtitle]]
+        """
+        return self.search_subtitles_videos(videos, timeout=timeout)[0]
+
+    def search_subtitles_videos(self, videos, timeout=None):
+        """Like list_subtitles_videos(), but also reports which searches actually finished, so that callers can tell
+        "no subtitles were found" apart from "the provider failed, was skipped, or ran out of time".
+        :param videos: dict[subliminal.video.Video, set[babelfish.Language]] the videos to search, and the languages to search for each one.
+        :param float timeout: (Optional) overall seconds to wait for results.
+        :return: tuple of dict[subliminal.video.Video, list[subliminal.subtitle.Subtitle]] and dict[subliminal.video.Video, set[str]],
+        the names of the providers that finished searching for each video.
+        """
+        listed_subtitles = {video: [] for video in videos}
+        completed = {video: set() for video in videos}
+        if len(videos) == 0:
+            return listed_subtitles, completed
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        max_workers = min(sum(self._limits.values()), len(videos) * len(self.providers))
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='psd-search')
+        futures = {}
+        for video, languages in videos.items():
+            for name in self.providers:
+                future = executor.submit(self.list_subtitles_provider, name, video, languages, deadline)
+                futures[future] = (video, name)
+
+        done, not_done = wait(futures, timeout=timeout)
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+        if len(not_done) > 0:
+            log.warning(f'{len(not_done)} of {len(futures)} subtitle searches did not finish within {timeout} seconds')
+
+        # Go through the results in the order they were submitted, so that the order of subtitles doesn't depend on timing
+        for future, (video, name) in futures.items():
+            if future not in done:
+                continue
+            provider_subtitles = future.result()
+            if provider_subtitles is not None:
+                listed_subtitles[video].extend(provider_subtitles)
+                completed[video].add(name)
+        return listed_subtitles, completed
+
+    def list_subtitles_provider(self, name, video, languages, deadline=None):
+        """Lists subtitles for the given video with a single provider.
+        :param str name: name of the provider.
+        :param video: subliminal.video.Video object
+        :param languages: set[babelfish.Language]
+        :param float deadline: (Optional) time.monotonic() value after which the search shouldn't be started.
+        :return: list[subliminal.subtitle.Subtitle], or None if the provider failed.
+        """
+        plugin = provider_manager[name].plugin
+        if not plugin.check(video):
+            log.debug(f'Skipping provider {name}: not a valid video')
+            return []
+
+        provider_languages = plugin.check_languages(languages)
+        if not provider_languages:
+            log.debug(f'Skipping provider {name}: no language to search for')
+            return []
+
+        if self.result_cache is not None:
+            subtitles = self.result_cache.get(name, video, provider_languages)
+            if subtitles is not None:
+                log.debug(f'Using {len(subtitles)} cached subtitles from provider {name} for languages {provider_languages}')
+                return subtitles
+
+        log.debug(f'Listing subtitles with provider {name} and languages {provider_languages}')
+        subtitles = self._call(name, lambda provider: provider.list_subtitles(video, provider_languages), deadline=deadline)
+        if subtitles is not None and self.result_cache is not None:
+            self.result_cache.put(name, video, provider_languages, subtitles)
+        return subtitles
+
+    def download_subtitle(self, subtitle):
+        """Downloads the content of the given subtitle.
+        :param subtitle: subliminal.subtitle.Subtitle object
+        :return: True if the subtitle was successfully downloaded, otherwise False.
+        """
+        log.debug(f'Downloading subtitle {subtitle}')
+        try:
+            self._call(subtitle.provider_name, lambda provider: provider.download_subtitle(subtitle), raise_errors=(BadZipfile, BadRarFile))
+        except (BadZipfile, BadRarFile):
+            log.error(f'Bad archive for subtitle {subtitle}')
+
+        if not subtitle.is_valid():
+            log.error(f'Invalid subtitle {subtitle}')
+            return False
+        return True
+
+    def download_subtitles(self, subtitles):
+        """Downloads the content of each of the given subtitles in one pass, running as many downloads
+        at once as each provider's concurrency limit allows.
+        :param subtitles: list[subliminal.subtitle.Subtitle]
+        :return: list[subliminal.subtitle.Subtitle] the subtitles that were successfully downloaded.
+        """
+        if len(subtitles) == 0:
+            return []
+
+        provider_names = set(subtitle.provider_name for subtitle in subtitles)
+        max_workers = sum(self._limits.get(name, 1) for name in provider_names)
+        log.info(f'Downloading {len(subtitles)} subtitles from {len(provider_names)} providers')
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='psd-download') as executor:
+            results = list(executor.map(self.download_subtitle, subtitles))
+
+        return [subtitle for subtitle, downloaded in zip(subtitles, results) if downloaded]
+
+    def stats(self):
+        """Returns a dict of each provider's circuit breaker state, and the requests left in its rate limit (if it has one)."""
+        stats = {}
+        for name in self.providers:
+            stats[name] = self._breakers[name].stats()
+            if name in self._rate_limits:
+                stats[name]['rate_limit_tokens'] = round(self._rate_limits[name].available(), 2)
+        return stats
+
+    def terminate(self):
+        """Logs out of every idle provider and stops the background keep-alive thread."""
+        self._stop.set()
+        with self._lock:
+            idle = [(name, provider) for name, entries in self._idle.items() for provider, last_used, last_ping in entries]
+            self._idle = {name: [] for name in self.providers}
+        for name, provider in idle:
+            self._terminate_provider(name, provider)
+
+    def _call(self, name, func, raise_errors=(), deadline=None):
+        """Calls func with a checked-out instance of the given provider. If the provider's session has expired,
+        it's logged back in and func is tried once more.
+        :return: the result of func, or None if the provider failed (or is being skipped, or the deadline passed before
+        a slot or rate limit token for the provider freed up).
+        """
+        semaphore = self._semaphores.get(name)
+        if semaphore is None:
+            log.error(f'Provider {name} is not one of the configured providers')
+            return None
+
+        breaker = self._breakers[name]
+        if breaker.skipping():
+            log.debug(f'Skipping provider {name}: too many failed requests')
+            return None
+
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and (timeout <= 0 or semaphore.acquire(timeout=timeout) == False):
+            log.debug(f'Deadline passed while waiting for provider {name}')
+            return None
+        elif timeout is None:
+            semaphore.acquire()
+
+        try:
+            rate_limit = self._rate_limits.get(name)
+            if rate_limit is not None and rate_limit.acquire(deadline) == False:
+                log.debug(f'Deadline passed while waiting for rate limit of provider {name}')
+                return None
+            if not breaker.allow():
+                log.debug(f'Skipping provider {name}: too many failed requests')
+                return None
+            return self._call_provider(name, func, raise_errors)
+        finally:
+            semaphore.release()
+
+    def _call_provider(self, name, func, raise_errors):
+        breaker = self._breakers[name]
+        for attempt in range(0, 2):
+            try:
+                provider = self._acquire(name)
+            except Exception as e:
+                breaker.record_failure(e)
+                handle_exception(e, f'Could not initialize provider {name}')
+                return None
+
+            try:
+                result = func(provider)
+            except raise_errors:
+                breaker.record_success()
+                self._release(name, provider)
+                raise
+            except AuthenticationError as e:
+                self._terminate_provider(name, provider)
+                if attempt == 0:
+                    log.info(f'Session for provider {name} is no longer valid, logging in again')
+                    continue
+                breaker.record_failure(e)
+                handle_exception(e, f'Provider {name}')
+                return None
+            except Exception as e:
+                breaker.record_failure(e)
+                self._terminate_provider(name, provider)
+                handle_exception(e, f'Provider {name}')
+                return None
+
+            breaker.record_success()
+            self._release(name, provider)
+            return result
+
+    def _get_limit(self, max_concurrency, name):
+        if isinstance(max_concurrency, dict):
+            return max(1, max_concurrency.get(name, 1))
+        return max(1, max_concurrency or 1)
+
+    def _acquire(self, name):
+        """Checks out an idle instance of the given provider, or initializes a new one."""
+        with self._lock:
+            entries = self._idle.setdefault(name, [])
+            if len(entries) > 0:
+                provider, last_used, last_ping = entries.pop()
+                return provider
+
+        log.info(f'Initializing provider {name}')
+        provider = provider_manager[name].plugin(**self.provider_configs.get(name, {}))
+        provider.initialize()
+        return provider
+
+    def _release(self, name, provider):
+        """Returns a checked-out provider to the pool."""
+        now = time.monotonic()
+        with self._lock:
+            self._idle.setdefault(name, []).append((provider, now, now))
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._run_reaper, name='psd-provider-reaper', daemon=True)
+                self._reaper.start()
+
+    def _terminate_provider(self, name, provider):
+        try:
+            log.info(f'Terminating provider {name}')
+            provider.terminate()
+        except Exception as e:
+            handle_exception(e, f'Provider {name} improperly terminated')
+
+    def _run_reaper(self):
+        interval = max(1, min(self.idle_timeout, self.keepalive_interval) / 2)
+        while not self._stop.wait(interval):
+            self._reap_idle()
+
+    def _reap_idle(self):
+        """Logs out of providers that have been idle for too long, and pings the rest to keep their sessions alive."""
+        now = time.monotonic()
+        expired = []
+        stale = []
+        with self._lock:
+            for name, entries in self._idle.items():
+                keep = []
+                for provider, last_used, last_ping in entries:
+                    if now - last_used > self.idle_timeout:
+                        expired.append((name, provider))
+                    elif now - last_ping > self.keepalive_interval and hasattr(provider, 'no_operation'):
+                        stale.append((name, provider, last_used))
+                    else:
+                        keep.append((provider, last_used, last_ping))
+                self._idle[name] = keep
+
+        for name, provider in expired:
+            log.debug(f'Provider {name} has been idle for more than {self.idle_timeout} seconds')
+            self._terminate_provider(name, provider)
+
+        for name, provider, last_used in stale:
+            try:
+                provider.no_operation()
+            except Exception as e:
+                log.debug(f'Keep-alive for provider {name} failed, dropping it: {e}')
+                self._terminate_provider(name, provider)
+                continue
+            with self._lock:
+                self._idle[name].append((provider, last_used, time.monotonic()))
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger('plex-sub-downloader')
+
+class LibraryReconciler:
+    """Periodically asks Plex for the movies and episodes that were added or updated recently, and dispatches the ones
+    that haven't been checked for missing subtitles yet. This catches anything the webhook missed, like items added
+    while `start-webhook` wasn't running or webhooks that Plex never sent.
+    The poll's watermark moves past items as soon as they're dispatched, so items whose jobs then fail aren't listed
+    again; instead, every poll calls `retry` to queue up failed jobs whose backoff has passed.
+    """
+
+    def __init__(self, plexHelper, processedItems, dispatch, interval=300, sections=None, page_size=200, retry=None):
+        """
+        :param PlexHelper plexHelper:
+        :param ProcessedItemStore processedItems: record of items that were already checked.
+        :param callable dispatch: called with a list of plexapi.video.Video objects that need to be checked.
+        Returns False if the videos couldn't be queued up, in which case they're retried on the next poll.
+        :param float interval: seconds between polls.
+        :param list sections: (Optional) list of section titles or ids to poll. Defaults to all movie and show sections.
+        :param int page_size: number of items to request from Plex at a time.
+        :param callable retry: (Optional) called on every poll to queue up failed jobs that are due to be retried.
+        """
+        self.plexHelper = plexHelper
+        self.processedItems = processedItems
+        self.dispatch = dispatch
+        self.interval = interval
+        self.sections = sections
+        self.page_size = page_size
+        self.retry = retry
+        self.since = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+        self.polls = 0
+        self.dispatched = 0
+        self.last_poll = None
+
+    def start(self):
+        """Starts polling Plex on a background thread."""
+        latest = self.processedItems.get_latest_updated_at()
+        self.since = latest if latest is not None else int(time.time() - self.interval)
+        log.info(f'Starting library reconciler, polling every {self.interval} seconds')
+        self._thread = threading.Thread(target=self._run, name='psd-reconciler', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops polling, and waits for a poll that's in progress to finish.
+        :param float timeout: (Optional) seconds to wait for the polling thread.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {'polls': self.polls, 'dispatched': self.dispatched, 'last_poll': self.last_poll}
+
+    def poll(self):
+        """Lists the items updated since the last poll in every section, and dispatches the ones that haven't been checked."""
+        log.debug(f'Polling Plex for items updated since {self.since}')
+        latest = self.since
+        delta = []
+        for section in self.plexHelper.get_library_sections(self.sections):
+            if section.type != 'movie' and section.type != 'show':
+                continue
+            for page in self.plexHelper.iter_section_videos(section, updated_since=self.since, page_size=self.page_size):
+                delta += self.processedItems.get_unprocessed(page)
+                for video in page:
+                    if video.updatedAt is not None:
+                        latest = max(latest, int(video.updatedAt.timestamp()))
+
+        if len(delta) > 0:
+            log.info(f'Found {len(delta)} recently added or updated items that haven\'t been checked for subtitles')
+            if self.dispatch(delta) == False:
+                log.warning('Could not queue up items found by the reconciler, they will be retried on the next poll')
+                latest = self.since
+                delta = []
+
+        with self._lock:
+            self.since = latest
+            self.polls += 1
+            self.dispatched += len(delta)
+            self.last_poll = time.time()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                log.error('Error while polling Plex for recently added or updated items')
+                log.error(e)
+            if self.retry is not None:
+                try:
+                    self.retry()
+                except Exception as e:
+                    log.error('Error while retrying failed jobs')
+                    log.error(e)
@@ -0,0 +1,38 @@
+import time
+import logging
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+class ScanWatermarkStore(SQLiteStore):
+    """On-disk record of how far `scan-library` has gotten through each library section.
+    The watermark is the `updatedAt` timestamp of the last item that was fully handled, so the next scan only has to
+    look at items that were added or changed since then.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS scan_watermarks (
+            section TEXT PRIMARY KEY,
+            updated_at INTEGER NOT NULL,
+            scanned_at REAL NOT NULL
+        )""",
+    )
+
+    def get_watermark(self, section):
+        """Returns the watermark for the given section.
+        :param str section: the section's uuid.
+        :return: int timestamp, or None if the section hasn't been scanned yet.
+        """
+        rows = self.execute('SELECT updated_at FROM scan_watermarks WHERE section = ?', (section,))
+        if len(rows) == 0:
+            return None
+        return rows[0][0]
+
+    def set_watermark(self, section, updated_at):
+        """Stores the watermark for the given section.
+        :param str section: the section's uuid.
+        :param int updated_at: timestamp of the last item that was handled.
+        """
+        log.debug(f'Setting scan watermark for section {section} to {updated_at}')
+        self.execute('INSERT OR REPLACE INTO scan_watermarks (section, updated_at, scanned_at) VALUES (?, ?, ?)',
+                     (section, updated_at, time.time()))
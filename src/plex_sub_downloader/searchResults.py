@@ -0,0 +1,101 @@
+import time
+import json
+import pickle
+import logging
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+class SearchResultCache(SQLiteStore):
+    """On-disk cache of the subtitles each provider listed for a video, so that searching the same video again
+    (like the next episode on every play event) doesn't have to ask the providers again until `ttl` seconds have passed.
+    Entries are keyed on the provider, the video (see get_video_key) and the set of languages searched for.
+    Only the subtitles' metadata is cached; their content is still downloaded when they're chosen.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS search_results (
+            provider TEXT NOT NULL,
+            video TEXT NOT NULL,
+            languages TEXT NOT NULL,
+            subtitles BLOB NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (provider, video, languages)
+        )""",
+        'CREATE INDEX IF NOT EXISTS search_results_created ON search_results (created)',
+    )
+
+    def __init__(self, path, ttl=3600):
+        """
+        :param str path: path to the database file.
+        :param float ttl: seconds that search results are reused for.
+        """
+        super().__init__(path)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.execute('DELETE FROM search_results WHERE created < ?', (time.time() - self.ttl,))
+
+    def get(self, provider, video, languages):
+        """Returns the subtitles the given provider listed for the given video and languages, if they haven't expired.
+        :param str provider: name of the provider.
+        :param video: subliminal.video.Video object
+        :param languages: set[babelfish.Language]
+        :return: list[subliminal.subtitle.Subtitle], or None if there are no cached results.
+        """
+        rows = self.execute('SELECT subtitles FROM search_results WHERE provider = ? AND video = ? AND languages = ? AND created >= ?',
+                            (provider, get_video_key(video), get_languages_key(languages), time.time() - self.ttl))
+        subtitles = None
+        if len(rows) > 0:
+            try:
+                subtitles = pickle.loads(rows[0][0])
+            except Exception as e:
+                log.warning(f'Could not load cached search results of provider {provider} for {video}: {e}')
+
+        with self._lock:
+            if subtitles is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return subtitles
+
+    def put(self, provider, video, languages, subtitles):
+        """Stores the subtitles the given provider listed for the given video and languages.
+        :param str provider: name of the provider.
+        :param video: subliminal.video.Video object
+        :param languages: set[babelfish.Language]
+        :param subtitles: list[subliminal.subtitle.Subtitle]
+        """
+        try:
+            data = pickle.dumps(subtitles, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.debug(f'Could not cache search results of provider {provider} for {video}: {e}')
+            return
+        self.execute('INSERT OR REPLACE INTO search_results (provider, video, languages, subtitles, created) VALUES (?, ?, ?, ?, ?)',
+                     (provider, get_video_key(video), get_languages_key(languages), data, time.time()))
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def get_video_key(video):
+    """Returns the key that identifies a video's search results: its hashes (which providers that search by hash use) and
+    what providers that search by name go by (the series, season and episode, or the title and year, and the IMDB id).
+    :param video: subliminal.video.Video object
+    :return: str
+    """
+    identity = {
+        'hashes': video.hashes,
+        'title': getattr(video, 'series', None) or getattr(video, 'title', None),
+        'year': getattr(video, 'year', None),
+        'season': getattr(video, 'season', None),
+        'episodes': getattr(video, 'episodes', None),
+        'imdb_id': getattr(video, 'series_imdb_id', None) or video.imdb_id,
+        'episode_imdb_id': video.imdb_id if hasattr(video, 'series_imdb_id') else None,
+    }
+    return json.dumps(identity, sort_keys=True, default=str)
+
+
+def get_languages_key(languages):
+    return ','.join(sorted(str(language) for language in languages))
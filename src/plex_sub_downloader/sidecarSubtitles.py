@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from babelfish import Language, Error as LanguageError
+from subliminal.subtitle import SUBTITLE_EXTENSIONS
+
+log = logging.getLogger('plex-sub-downloader')
+
+class SidecarIndex:
+    """Finds the subtitle files sitting next to video files (`<video name>.<language>.<extension>`, like the ones
+    PlexSubDownloader saves when `subtitle_destination` is `with_media`), so that subtitles that were just saved
+    aren't searched for again before Plex has picked them up.
+    Each directory is listed once and kept until its mtime changes. At most `max_directories` listings are kept,
+    dropping the least recently used.
+    """
+
+    def __init__(self, max_directories=1024):
+        """
+        :param int max_directories: maximum number of directory listings to keep.
+        """
+        self.max_directories = max_directories
+        self.hits = 0
+        self.misses = 0
+        self._directories = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_languages(self, video_path, formats=None):
+        """Returns the languages of the subtitle files next to the given video file.
+        :param str video_path: path to the video file.
+        :param list formats: (Optional) subtitle formats (extensions without the '.') to look for. Defaults to every
+        format subliminal knows about.
+        :return: set of alpha3 language codes.
+        """
+        directory, filename = os.path.split(video_path)
+        sidecars = self._get_directory(directory).get(os.path.splitext(filename)[0], [])
+        if formats is None:
+            return set(language for language, fmt in sidecars)
+        return set(language for language, fmt in sidecars if fmt in formats)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'directories': len(self._directories)}
+
+    def _get_directory(self, directory):
+        """Returns the subtitle files in the given directory, listing it again if it has changed since it was last listed.
+        :return: dict of video names to lists of (alpha3 language code, format) tuples.
+        """
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError as e:
+            log.debug(f'Could not check {directory} for subtitle files: {e}')
+            return {}
+
+        with self._lock:
+            cached = self._directories.get(directory)
+            if cached is not None and cached[0] == mtime:
+                self._directories.move_to_end(directory)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        listed = time.time_ns()
+        try:
+            sidecars = index_subtitle_files(os.listdir(directory))
+        except OSError as e:
+            log.debug(f'Could not list {directory} for subtitle files: {e}')
+            return {}
+
+        # A file added in the same instant as the listing might not change the mtime, so only keep listings
+        # of directories that hadn't been changed for a moment before they were listed.
+        if listed - mtime > 1000000000:
+            with self._lock:
+                self._directories[directory] = (mtime, sidecars)
+                self._directories.move_to_end(directory)
+                while len(self._directories) > self.max_directories:
+                    self._directories.popitem(last=False)
+        return sidecars
+
+
+def index_subtitle_files(filenames):
+    """Picks the subtitle files named like `<video name>.<language>.<extension>` out of the given file names.
+    :param list filenames: list of file names.
+    :return: dict of video names to lists of (alpha3 language code, format) tuples.
+    """
+    sidecars = {}
+    for filename in filenames:
+        parts = filename.rsplit('.', 2)
+        if len(parts) != 3 or '.' + parts[2].lower() not in SUBTITLE_EXTENSIONS:
+            continue
+        language = get_alpha3(parts[1])
+        if language is not None:
+            sidecars.setdefault(parts[0], []).append((language, parts[2].lower()))
+    return sidecars
+
+
+def get_alpha3(code):
+    """Returns the alpha3 code of the given language code (like `en`, `eng`, `fre` or `pt-BR`), or None if it isn't one."""
+    for convert in (Language.fromietf, Language.fromalpha3b):
+        try:
+            return convert(code).alpha3
+        except (LanguageError, ValueError):
+            continue
+    return None
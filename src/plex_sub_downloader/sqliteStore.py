@@ -0,0 +1,48 @@
+import os
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger('plex-sub-downloader')
+
+class SQLiteStore:
+    """Base class for the small SQLite databases that PlexSubDownloader keeps in its cache directory.
+    One connection is shared between threads and guarded by a lock. The database runs in WAL mode, so that
+    another process (like a `check-video` run next to the webhook) can read it without blocking.
+    Subclasses list their CREATE statements in `schema`.
+    """
+
+    schema = ()
+
+    def __init__(self, path):
+        """
+        :param str path: path to the database file. Missing directories are created.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._lock, self._conn:
+            for statement in self.schema:
+                self._conn.execute(statement)
+
+    def execute(self, sql, params=()):
+        """Runs a single statement in its own transaction.
+        :return: list of result rows.
+        """
+        with self._lock, self._conn:
+            return self._conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, params):
+        """Runs a statement once for each set of params, in a single transaction."""
+        with self._lock, self._conn:
+            self._conn.executemany(sql, params)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,49 +1,58 @@
 import os
 from re import sub
-from pathlib import Path
-from operator import itemgetter
 
 from babelfish import *
 import subliminal
 from subliminal import region
 from subliminal.score import compute_score
-from subliminal.core import ProviderPool
+from subliminal.core import check_video
 from subliminal.providers.opensubtitles import ( OpenSubtitlesVipProvider, OpenSubtitlesVipSubtitle)
-from subliminal.video import (Video as SubVideo, Episode, Movie)
+from subliminal.video import (Video as SubVideo, Episode, Movie, VIDEO_EXTENSIONS)
 from subliminal.subtitle import Subtitle
-from subliminal.utils import hash_napiprojekt, hash_opensubtitles, hash_shooter, hash_thesubdb
 
 from plexapi import media
 from plexapi.media import (Media, MediaPart)
 from plexapi.video import Video as PlexVideo
 import logging
 import itertools
+from .providerPool import PersistentProviderPool
+from .cacheBackends import configure_region
+from .videoHashes import compute_video_hashes, get_hash_names
 
 log = logging.getLogger('plex-sub-downloader')
 
 class SubliminalHelper:
 
-    def __init__(self, providers=None, provider_configs=None, format_priority=None):
+    def __init__(self, providers=None, provider_configs=None, format_priority=None, provider_idle_timeout=1800, provider_keepalive_interval=600, provider_concurrency=2, provider_failure_threshold=5, provider_failure_cooldown=300, search_timeout=None, hash_cache=None, negative_cache=None, result_cache=None, subtitle_store=None, cache_config=None, cache_dir='.'):
 
+        self.cache_stats = None
         if region.is_configured == False:
-            region.configure('dogpile.cache.dbm', arguments={'filename': 'subliminalCache.dbm'})
+            self.cache_stats = configure_region(region, cache_config, cache_dir)
         self.format_priority = format_priority
+        self._format_priorities = None
         self.providers = providers
         if providers is None and provider_configs is not None:
             self.providers = [provider for provider in provider_configs]
 
         self.provider_configs = provider_configs
+        self.search_timeout = search_timeout
+        self.hash_cache = hash_cache
+        self.negative_cache = negative_cache
+        self.result_cache = result_cache
+        self.subtitle_store = subtitle_store
 
         log.debug("Setting up Subliminal with configs:")
         log.debug("providers:")
         log.debug(self.providers)
 
-        self.hash_functions = {
-            'opensubtitles': hash_opensubtitles,
-            'shooter': hash_shooter,
-            'thesubdb': hash_thesubdb,
-            'napiprojekt': hash_napiprojekt,
-        }
+        self.providerPool = PersistentProviderPool(providers=self.providers, 
+                                                   provider_configs=self.provider_configs,
+                                                   idle_timeout=provider_idle_timeout,
+                                                   keepalive_interval=provider_keepalive_interval,
+                                                   max_concurrency=provider_concurrency,
+                                                   failure_threshold=provider_failure_threshold,
+                                                   failure_cooldown=provider_failure_cooldown,
+                                                   result_cache=result_cache)
 
     def search_video(self, video, languages):
         """Searches subtitles for the given video.
@@ -69,7 +78,7 @@ class SubliminalHelper:
         """
         sub_languages = [[subliminal.core.Language(l) for l in vid_langs] for vid_langs in languages]
         languages_list = set(itertools.chain.from_iterable(sub_languages))
-        subtitles = subliminal.list_subtitles(videos, languages=languages_list, providers=self.providers, provider_configs=self.provider_configs)
+        subtitles, searched = self.search_subtitles(videos, languages_list)
         
         best_subtitles = {}
 
@@ -79,38 +88,157 @@ class SubliminalHelper:
             subs = subtitles[video]
             best_subs = self.select_best_subtitles(video, subs, video_languages)
             if best_subs is not None:
-                subliminal.core.download_subtitles(best_subs, providers=self.providers, provider_configs=self.provider_configs)
                 best_subtitles[video] = best_subs
         
+        # Download the chosen subtitles for every video in one pass
+        self.download_subtitles(list(itertools.chain.from_iterable(best_subtitles.values())))
         log.debug(best_subtitles)
+
+        # Only videos that every provider finished searching say anything about which subtitles exist
+        if self.negative_cache is not None:
+            for i in range(0, len(videos)):
+                if videos[i] in searched:
+                    self.record_search_results(videos[i], languages[i], best_subtitles.get(videos[i], []))
         return best_subtitles
 
+    def download_subtitles(self, subtitles):
+        """Downloads the content of the given subtitles. Subtitles that are in the subtitle store are read from there instead,
+        and newly downloaded subtitles are added to it.
+        :param subtitles: list[subliminal.subtitle.Subtitle]
+        :return: list[subliminal.subtitle.Subtitle] the subtitles that were successfully downloaded (or loaded).
+        """
+        if self.subtitle_store is None:
+            return self.providerPool.download_subtitles(subtitles)
+
+        stored = []
+        missing = []
+        for subtitle in subtitles:
+            if self.subtitle_store.load(subtitle):
+                stored.append(subtitle)
+            else:
+                missing.append(subtitle)
+
+        downloaded = self.providerPool.download_subtitles(missing)
+        for subtitle in downloaded:
+            self.subtitle_store.save(subtitle)
+        return stored + downloaded
+
+    def record_search_results(self, video, languages, subtitles):
+        """Updates the negative result cache with which of the searched-for languages were (or weren't) found for the given video.
+        Should only be called once every provider has finished searching for the video. Languages that a subtitle was chosen
+        for, but couldn't be downloaded, are left alone.
+        :param video: subliminal.video.Video object
+        :param languages: list[str] language codes that were searched for.
+        :param subtitles: list[subliminal.subtitle.Subtitle] subtitles that were chosen for the video.
+        """
+        found_languages = set(subtitle.language.alpha3 for subtitle in subtitles if subtitle.content is not None)
+        chosen_languages = set(subtitle.language.alpha3 for subtitle in subtitles)
+        found = [l for l in languages if subliminal.core.Language(l).alpha3 in found_languages]
+        missed = [l for l in languages if subliminal.core.Language(l).alpha3 not in chosen_languages]
+        self.negative_cache.clear(video.name, found)
+        self.negative_cache.record_misses(video.name, missed)
+
+    def get_suppressed_languages(self, video, languages):
+        """Returns the languages that recently couldn't be found for the given video, and shouldn't be searched for again yet.
+        :param video: plexapi.video.Video object
+        :param languages: list[str] language codes.
+        :return: list[str] language codes.
+        """
+        if self.negative_cache is None:
+            return []
+        return self.negative_cache.get_suppressed_languages(video.media[0].parts[0].file, languages)
+
+    def list_subtitles(self, videos, languages):
+        """Lists subtitles for the given videos using the shared provider pool.
+        :param videos: list[subliminal.video.Video]
+        :param languages: set[babelfish.Language]
+        :return: dict[subliminal.video.Video, list[subliminal.subtitle.Subtitle]]
+        """
+        return self.search_subtitles(videos, languages)[0]
+
+    def search_subtitles(self, videos, languages):
+        """Like list_subtitles(), but also returns which videos were actually searched by every provider (as opposed to
+        skipped, or left with providers that failed, were skipped, or ran out of time).
+        :param videos: list[subliminal.video.Video]
+        :param languages: set[babelfish.Language]
+        :return: tuple of dict[subliminal.video.Video, list[subliminal.subtitle.Subtitle]] and set[subliminal.video.Video]
+        """
+        listed_subtitles = {}
+        videos_to_search = {}
+        for video in videos:
+            if not check_video(video, languages=languages):
+                log.info(f'Skipping video {video}')
+                listed_subtitles[video] = []
+                continue
+            videos_to_search[video] = languages - video.subtitle_languages
+            
+        found_subtitles, completed = self.providerPool.search_subtitles_videos(videos_to_search, timeout=self.search_timeout)
+        for video, subtitles in found_subtitles.items():
+            log.info(f'Found {len(subtitles)} subtitles for video {video}')
+            listed_subtitles[video] = subtitles
+
+        searched = set(video for video, providers in completed.items() if providers.issuperset(self.providerPool.providers))
+        return listed_subtitles, searched
+
+    def get_cache_stats(self):
+        """Returns hit and miss counters for the caches used when searching for subtitles.
+        :return: dict
+        """
+        stats = {}
+        if self.cache_stats is not None:
+            stats['subliminal_cache'] = self.cache_stats.stats()
+        if self.hash_cache is not None:
+            stats['hash_cache'] = {'hits': self.hash_cache.hits, 'misses': self.hash_cache.misses}
+        if self.result_cache is not None:
+            stats['search_result_cache'] = self.result_cache.stats()
+        if self.subtitle_store is not None:
+            stats['subtitle_store'] = self.subtitle_store.stats()
+        return stats
+
+    def get_provider_stats(self):
+        """Returns the state of each subtitle provider's circuit breaker and rate limit.
+        :return: dict
+        """
+        return self.providerPool.stats()
+
+    def terminate(self):
+        """Logs out of any subtitle providers that are still logged in."""
+        self.providerPool.terminate()
+
     def select_best_subtitles(self, video, subtitles, languages):
         """Selects the 'best' subtitles for the given video based on a combination of factors, including subliminal.score.compute_score, and subtitle format priority. 
         Returns 1 subtitle for each language (if any were found).
+        The subtitles are only gone through once: each subtitle's format and score are worked out once (and only for subtitles
+        in one of the given languages), and the best subtitle so far for each language is kept.
         :param video: subliminal.video.Video object
         :param subtitles: list[subliminal.subtitle.Subtitle]
         :param languages: list[subliminal.core.Language]
         :return: list[subliminal.subtitle.Subtitle]
         """
-        subtitles = self.filter_subtitles(video, subtitles)
-
-        # Build a decorated list of subtitles that includes their "score" and their format priority.
-        # Sort the list by format priority from highest to lowest, and then score from highest to lowest.
-        decorated_subtitles = [(compute_score(subtitle, video), self._get_subtitle_format_priority(subtitle, video), subtitle) for subtitle in subtitles]
-        decorated_subtitles.sort(key=itemgetter(1), reverse=True)
-        decorated_subtitles.sort(key=itemgetter(0), reverse=True)
-        subtitles = [subtitle for score, fmt_priority, subtitle in decorated_subtitles]
-
-        # Find the first subtitle for each language
-        selected_subtitles = [] 
-        for lang in languages:
-            for sub in subtitles:
-                if sub.language == lang:
-                    selected_subtitles.append(sub)
-                    break
-
-        return selected_subtitles
+        format_priorities = self._get_format_priorities()
+
+        # Keep the subtitle with the highest score for each language, using format priority to break ties.
+        # On a complete tie, the first subtitle wins.
+        # Languages are keyed on their parts, since hashing a babelfish Language formats it as a string every time.
+        best_subtitles = {self._get_language_key(lang): None for lang in languages}
+        for subtitle in subtitles:
+            language = self._get_language_key(subtitle.language)
+            best = best_subtitles.get(language, False)
+            if best is False:
+                continue
+
+            fmt_priority = 0
+            if format_priorities is not None:
+                fmt_priority = format_priorities.get(self._get_subtitle_format(subtitle, video))
+                if fmt_priority is None:
+                    continue
+
+            rank = (compute_score(subtitle, video), fmt_priority)
+            if best is None or rank > best[0]:
+                best_subtitles[language] = (rank, subtitle)
+
+        selected = [best_subtitles[self._get_language_key(lang)] for lang in languages]
+        return [best[1] for best in selected if best is not None]
 
     def filter_subtitles(self, video, subtitles):
         """Filters the list of subtitles based on config preferences.
@@ -118,13 +246,10 @@ class SubliminalHelper:
         :param subtitles: list[subliminal.subtitle.Subtitle]
         :return: list[subliminal.subtitle.Subtitle]
         """
-
-        filtered_subtitles = subtitles.copy()
-        
-        if self.format_priority is not None:
-            filtered_subtitles = [s for s in filtered_subtitles if self._get_subtitle_format(s, video) in self.format_priority]
-        
-        return filtered_subtitles
+        format_priorities = self._get_format_priorities()
+        if format_priorities is None:
+            return subtitles.copy()
+        return [s for s in subtitles if self._get_subtitle_format(s, video) in format_priorities]
 
     def save_subtitle(self, video, subtitle, destination=None):
         """Saves the given subtitle (or subtitles) for the given video.
@@ -150,6 +275,24 @@ class SubliminalHelper:
             savedFilepaths.append(savedSubtitlePath)
         return savedFilepaths
 
+    def get_subtitle_files(self, video, subtitles):
+        """Returns the file name and contents that save_subtitle() would have written for each of the given subtitles,
+        without writing anything to disk. Like save_subtitle(), only the first subtitle for each language is kept.
+        The contents are re-encoded as UTF-8.
+        :param subliminal.video.Video video:
+        :param list subtitles: list of subliminal.subtitle.Subtitle objects.
+        :return: list of (str, bytes) tuples of file names and contents.
+        """
+        files = []
+        languages = set()
+        for subtitle in subtitles:
+            if subtitle.content is None or subtitle.language in languages:
+                continue
+            languages.add(subtitle.language)
+            filename = os.path.basename(subtitle.get_path(video, single=False))
+            files.append((filename, subtitle.text.encode('utf-8')))
+        return files
+
     def save_subtitles(self, subtitles):
         """Saves subtitles for mutliple videos.
         :param subtitles: dict[subliminal.video.Video, list[Subliminal.subtitle.Subtitle]]
@@ -217,25 +360,74 @@ class SubliminalHelper:
         if os.path.exists(subVideo.name) == False:
             return subVideo
         
-        for provider in self.providers:
-                if provider in self.hash_functions.keys():
-                    subVideo.hashes[provider] = self.hash_functions[provider](subVideo.name)
+        if self.hash_cache is not None:
+            subVideo.hashes.update(self.hash_cache.get_hashes(subVideo.name, self.providers))
+            return subVideo
+
+        hashes = compute_video_hashes(subVideo.name, get_hash_names(self.providers))
+        subVideo.hashes.update({hash_name: filehash for hash_name, filehash in hashes.items() if filehash is not None})
         return subVideo
+
+    def warm_hash_cache(self, directories):
+        """Walks the given directories and computes hashes for every video file that would be hashed when searching for subtitles,
+        so that later searches don't have to read the files.
+        :param directories: list[str] directories to walk.
+        :return: int number of files hashed.
+        """
+        if self.hash_cache is None:
+            log.error("The hash cache is not enabled.")
+            return 0
+
+        hashed = 0
+        for directory in directories:
+            log.info(f'Hashing video files in {directory}')
+            for root, dirnames, filenames in os.walk(directory):
+                for filename in filenames:
+                    if not filename.lower().endswith(VIDEO_EXTENSIONS):
+                        continue
+                    filepath = os.path.join(root, filename)
+                    try:
+                        if os.path.getsize(filepath) <= 10485760:
+                            continue
+                        self.hash_cache.get_hashes(filepath, self.providers)
+                    except OSError as e:
+                        log.error(f'Could not hash {filepath}: {e}')
+                        continue
+
+                    hashed += 1
+                    if hashed % 100 == 0:
+                        log.info(f'Hashed {hashed} video files')
+        
+        log.info(f'Hashed {hashed} video files ({self.hash_cache.misses} were new or had changed)')
+        return hashed
         
     def _get_subtitle_format(self, subtitle, video):
         """Returns the file extension for the given subtitle, with the '.' removed."""
 
-        return Path(subtitle.get_path(video)).suffix.replace(".", "")
+        return os.path.splitext(subtitle.get_path(video))[1].replace(".", "")
     
+    def _get_language_key(self, language):
+        return (language.alpha3, language.country, language.script)
+
+    def _get_format_priorities(self):
+        """Returns a dict of formats to their 'priority' (see _get_subtitle_format_priority), or None if `format_priority` isn't set.
+        The dict is only rebuilt when `format_priority` changes.
+        """
+        if self.format_priority is None:
+            return None
+        if self._format_priorities is None or self._format_priorities[0] is not self.format_priority:
+            priorities = {}
+            for i, fmt in enumerate(self.format_priority):
+                priorities.setdefault(fmt, len(self.format_priority) - i)
+            self._format_priorities = (self.format_priority, priorities)
+        return self._format_priorities[1]
+
     def _get_subtitle_format_priority(self, subtitle, video):
         """Returns the 'priority' of the format for the given subtitle, based on the `subtitle_preferences` config.
         A higher value is considered higher priority. A value of -1 means that the given format was not found in `subtitle_preferences`.
         If `subtitle_preferences` is None, then this will return 0 for all format. 
         """
-        if self.format_priority is None:
+        format_priorities = self._get_format_priorities()
+        if format_priorities is None:
             return 0
-
-        fmt = self._get_subtitle_format(subtitle, video)
-        if fmt not in self.format_priority:
-            return -1
-        return len(self.format_priority) - self.format_priority.index(fmt)
\ No newline at end of file
+        return format_priorities.get(self._get_subtitle_format(subtitle, video), -1)
\ No newline at end of file
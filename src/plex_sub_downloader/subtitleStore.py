@@ -0,0 +1,101 @@
+import time
+import hashlib
+import logging
+from .sqliteStore import SQLiteStore
+
+log = logging.getLogger('plex-sub-downloader')
+
+class SubtitleStore(SQLiteStore):
+    """On-disk store of downloaded subtitle files, so that downloading the same subtitle again (for another edition of
+    the same release, after a file upgrade, or when retrying a failed upload) is read from disk instead of counting
+    against the provider's download quota.
+    Files are stored once per content hash, and looked up by provider and subtitle id. Once the files add up to more
+    than `max_size` bytes, the least recently used ones are evicted.
+    """
+
+    schema = (
+        """CREATE TABLE IF NOT EXISTS subtitle_contents (
+            content_hash TEXT PRIMARY KEY,
+            content BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            last_used REAL NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS subtitle_contents_last_used ON subtitle_contents (last_used)',
+        """CREATE TABLE IF NOT EXISTS subtitle_ids (
+            provider TEXT NOT NULL,
+            subtitle_id TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            PRIMARY KEY (provider, subtitle_id)
+        )""",
+        'CREATE INDEX IF NOT EXISTS subtitle_ids_content_hash ON subtitle_ids (content_hash)',
+    )
+
+    def __init__(self, path, max_size=104857600):
+        """
+        :param str path: path to the database file.
+        :param int max_size: maximum total size of the stored files in bytes. Defaults to 100 MB.
+        """
+        super().__init__(path)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, subtitle):
+        """Sets the content of the given subtitle from the store, if it has been downloaded before.
+        :param subtitle: subliminal.subtitle.Subtitle object
+        :return: True if the subtitle's content was loaded, otherwise False.
+        """
+        with self._lock:
+            rows = self.execute("""SELECT c.content_hash, c.content FROM subtitle_ids i
+                                   JOIN subtitle_contents c ON c.content_hash = i.content_hash
+                                   WHERE i.provider = ? AND i.subtitle_id = ?""", (subtitle.provider_name, str(subtitle.id)))
+            if len(rows) == 0:
+                self.misses += 1
+                return False
+
+            content_hash, content = rows[0]
+            self.execute('UPDATE subtitle_contents SET last_used = ? WHERE content_hash = ?', (time.time(), content_hash))
+            self.hits += 1
+
+        log.debug(f'Loaded subtitle {subtitle} from the subtitle store')
+        subtitle.content = bytes(content)
+        return True
+
+    def save(self, subtitle):
+        """Stores the content of the given (downloaded) subtitle, evicting the least recently used files if the store is full.
+        :param subtitle: subliminal.subtitle.Subtitle object
+        """
+        if subtitle.content is None:
+            return
+        content_hash = hashlib.sha256(subtitle.content).hexdigest()
+        with self._lock:
+            self.execute("""INSERT INTO subtitle_contents (content_hash, content, size, last_used) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (content_hash) DO UPDATE SET last_used = excluded.last_used""",
+                         (content_hash, subtitle.content, len(subtitle.content), time.time()))
+            self.execute('INSERT OR REPLACE INTO subtitle_ids (provider, subtitle_id, content_hash) VALUES (?, ?, ?)',
+                         (subtitle.provider_name, str(subtitle.id), content_hash))
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used files until the store is no bigger than `max_size`."""
+        with self._lock:
+            excess = self.execute('SELECT COALESCE(SUM(size), 0) FROM subtitle_contents')[0][0] - self.max_size
+            if excess <= 0:
+                return
+
+            evicted = []
+            for content_hash, size in self.execute('SELECT content_hash, size FROM subtitle_contents ORDER BY last_used'):
+                if excess <= 0:
+                    break
+                evicted.append((content_hash,))
+                excess -= size
+
+            log.debug(f'Evicting {len(evicted)} files from the subtitle store')
+            with self._conn:
+                self._conn.executemany('DELETE FROM subtitle_ids WHERE content_hash = ?', evicted)
+                self._conn.executemany('DELETE FROM subtitle_contents WHERE content_hash = ?', evicted)
+
+    def stats(self):
+        with self._lock:
+            rows = self.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM subtitle_contents')
+            return {'hits': self.hits, 'misses': self.misses, 'files': rows[0][0], 'size': rows[0][1]}
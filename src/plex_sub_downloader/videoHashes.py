@@ -0,0 +1,123 @@
+import os
+import hashlib
+import struct
+
+# Number of bytes each hash reads, matching the implementations in subliminal.utils
+OPENSUBTITLES_CHUNK_SIZE = 65536
+THESUBDB_CHUNK_SIZE = 65536
+SHOOTER_BLOCK_SIZE = 4096
+NAPIPROJEKT_READ_SIZE = 10485760
+
+# The name of the hash (the key in subliminal.video.Video.hashes) that each provider searches by
+PROVIDER_HASHES = {
+    'opensubtitles': 'opensubtitles',
+    'opensubtitlesvip': 'opensubtitles',
+    'shooter': 'shooter',
+    'thesubdb': 'thesubdb',
+    'napiprojekt': 'napiprojekt',
+}
+
+def get_hash_names(providers):
+    """Returns the names of the hashes needed by the given subtitle providers.
+    :param list providers: names of subtitle providers.
+    :return: list[str]
+    """
+    hash_names = []
+    for provider in providers:
+        hash_name = PROVIDER_HASHES.get(provider, None)
+        if hash_name is not None and hash_name not in hash_names:
+            hash_names.append(hash_name)
+    return hash_names
+
+def compute_video_hashes(path, hash_names):
+    """Computes the given hashes in a single pass over the file.
+    The file is opened once, the union of the byte ranges that the hashes need (the head, the tail, and shooter's two
+    blocks from the middle) is read once, and every hash is computed from those buffers. The results are the same as
+    the hash_* functions in subliminal.utils.
+    :param str path: path to the video file.
+    :param list hash_names: names of the hashes to compute (see get_hash_names()).
+    :return: dict[str, str] of hash names to hashes. A hash is None if the file is too small for it.
+    """
+    if len(hash_names) == 0:
+        return {}
+
+    with open(path, 'rb') as f:
+        reader = _RangeReader(f, os.fstat(f.fileno()).st_size, hash_names)
+        hashes = {}
+        for hash_name in hash_names:
+            if hash_name == 'opensubtitles':
+                hashes[hash_name] = _hash_opensubtitles(reader)
+            elif hash_name == 'thesubdb':
+                hashes[hash_name] = _hash_thesubdb(reader)
+            elif hash_name == 'shooter':
+                hashes[hash_name] = _hash_shooter(reader)
+            elif hash_name == 'napiprojekt':
+                hashes[hash_name] = _hash_napiprojekt(reader)
+        return hashes
+
+
+class _RangeReader:
+    """Reads the head and tail of a file up front, and serves byte ranges from those buffers where it can."""
+
+    def __init__(self, f, size, hash_names):
+        self.f = f
+        self.size = size
+
+        head_size = 0
+        tail_size = 0
+        if 'napiprojekt' in hash_names:
+            head_size = max(head_size, NAPIPROJEKT_READ_SIZE)
+        if 'opensubtitles' in hash_names:
+            head_size = max(head_size, OPENSUBTITLES_CHUNK_SIZE)
+            tail_size = max(tail_size, OPENSUBTITLES_CHUNK_SIZE)
+        if 'thesubdb' in hash_names:
+            head_size = max(head_size, THESUBDB_CHUNK_SIZE)
+            tail_size = max(tail_size, THESUBDB_CHUNK_SIZE)
+        if 'shooter' in hash_names:
+            head_size = max(head_size, SHOOTER_BLOCK_SIZE * 2)
+            tail_size = max(tail_size, SHOOTER_BLOCK_SIZE * 2)
+
+        self.head = f.read(head_size)
+        self.tail_start = max(len(self.head), size - tail_size)
+        self.tail = b''
+        if self.tail_start < size:
+            f.seek(self.tail_start)
+            self.tail = f.read(size - self.tail_start)
+
+    def read(self, offset, length):
+        end = offset + length
+        if end <= len(self.head):
+            return self.head[offset:end]
+        if offset >= self.tail_start:
+            return self.tail[offset - self.tail_start:end - self.tail_start]
+        if offset < len(self.head) and end >= self.tail_start:
+            return (self.head + self.tail)[offset:end]
+        self.f.seek(offset)
+        return self.f.read(length)
+
+
+def _hash_opensubtitles(reader):
+    if reader.size < OPENSUBTITLES_CHUNK_SIZE * 2:
+        return None
+
+    count = OPENSUBTITLES_CHUNK_SIZE // 8
+    chunks = reader.read(0, OPENSUBTITLES_CHUNK_SIZE) + reader.read(reader.size - OPENSUBTITLES_CHUNK_SIZE, OPENSUBTITLES_CHUNK_SIZE)
+    filehash = reader.size + sum(struct.unpack(f'<{count * 2}Q', chunks))
+    return '%016x' % (filehash & 0xFFFFFFFFFFFFFFFF)
+
+def _hash_thesubdb(reader):
+    if reader.size < THESUBDB_CHUNK_SIZE:
+        return None
+
+    data = reader.read(0, THESUBDB_CHUNK_SIZE) + reader.read(reader.size - THESUBDB_CHUNK_SIZE, THESUBDB_CHUNK_SIZE)
+    return hashlib.md5(data).hexdigest()
+
+def _hash_shooter(reader):
+    if reader.size < SHOOTER_BLOCK_SIZE * 2:
+        return None
+
+    offsets = (SHOOTER_BLOCK_SIZE, reader.size // 3 * 2, reader.size // 3, reader.size - SHOOTER_BLOCK_SIZE * 2)
+    return ';'.join(hashlib.md5(reader.read(offset, SHOOTER_BLOCK_SIZE)).hexdigest() for offset in offsets)
+
+def _hash_napiprojekt(reader):
+    return hashlib.md5(reader.read(0, NAPIPROJEKT_READ_SIZE)).hexdigest()